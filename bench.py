@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+__all__ = ['benchmarks', 'run', 'compare']
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+from field import Field
+from curve import Curve
+from isogeny import TwoIsogeny, FourIsogeny, IsogenyChain
+from magic import get_kernel_point
+from sqisign import (p, f, msg, basis_store, deterministic_basis_two_torsion,
+                     verify_uncompressed_signature, verify_compressed_signature, verify_uncompressed_batch)
+
+# Benchmarks of the building blocks and of verification, with both their
+# wall-clock time and their exact Field.counts:
+#     python3 bench.py run --output results.json
+#     python3 bench.py compare baseline.json results.json --threshold .1
+# A benchmark is a setup function, which gets the field and returns the
+# function to time. The random module is seeded before every setup, and
+# stores are cleared in the timed functions that use them, so that every
+# call does the same work and the counts are reproducible. A call is timed
+# over enough iterations to take at least min_time seconds, and the times
+# are those of a single call. compare flags a benchmark whose median time
+# grew by more than the threshold, or whose Field.cost grew at all (or by
+# more than cost_threshold).
+
+benchmarks = {}
+
+def benchmark(name):
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+@benchmark('field.add')
+def _(gf):
+    a, b = gf.random(), gf.random()
+    return lambda: a + b
+
+@benchmark('field.mul')
+def _(gf):
+    a, b = gf.random(), gf.random()
+    return lambda: a * b
+
+@benchmark('field.sq')
+def _(gf):
+    a = gf.random()
+    return lambda: a**2
+
+@benchmark('field.inv')
+def _(gf):
+    a = gf.random()
+    return lambda: ~a
+
+@benchmark('field.is_square')
+def _(gf):
+    a = gf.random()
+    return lambda: a.is_square()
+
+@benchmark('field.sqrt')
+def _(gf):
+    a = gf.random()**2
+    return lambda: a.sqrt()
+
+def _point(gf):
+    E = Curve(gf(6))
+    P = E.random()
+    return E, P
+
+@benchmark('curve.xDBL')
+def _(gf):
+    E, P = _point(gf)
+    return lambda: E.xDBL(P)
+
+@benchmark('curve.xADD')
+def _(gf):
+    E, P = _point(gf)
+    Q = E.random()
+    PQ = E.xADD(P, Q, E.random())      # any point will do for the timing
+    return lambda: E.xADD(P, Q, PQ)
+
+@benchmark('curve.ladder')
+def _(gf):
+    E, P = _point(gf)
+    s = random.randrange(2**f) | 1
+    return lambda: P * s
+
+@benchmark('curve.double_k')
+def _(gf):
+    E, P = _point(gf)
+    return lambda: P.double_k(f)
+
+def _kernel(gf):
+    # a point of order 2^f on y² = x³ + 6x² + x
+    E = Curve(gf(6))
+    P, _ = deterministic_basis_two_torsion(E)
+    return P
+
+@benchmark('isogeny.two')
+def _(gf):
+    P = _kernel(gf)
+    K = P.double_k(f - 1)
+    return lambda: TwoIsogeny(K)(P)
+
+@benchmark('isogeny.four')
+def _(gf):
+    P = _kernel(gf)
+    K = P.double_k(f - 2)
+    return lambda: FourIsogeny(K)(P)
+
+@benchmark('isogeny.chain128')
+def _(gf):
+    P = _kernel(gf)
+    return lambda: IsogenyChain(P, 128)
+
+@benchmark('isogeny.chain128.radix4')
+def _(gf):
+    P = _kernel(gf)
+    return lambda: IsogenyChain(P, 128, radix=4)
+
+@benchmark('basis.deterministic')
+def _(gf):
+    E = Curve(gf(6))
+    return lambda: deterministic_basis_two_torsion(E, difference=True)
+
+@benchmark('magic.get_kernel_point')
+def _(gf):
+    E = Curve(gf(6))
+    P, Q, PmQ = deterministic_basis_two_torsion(E, difference=True)
+    s = random.randrange(2**f)
+    return lambda: get_kernel_point(P, Q, s, PmQ)
+
+def _signatures(gf):
+    from good_signatures import get_signatures
+    return get_signatures(gf.i())
+
+@benchmark('verify.uncompressed')
+def _(gf):
+    pk, sig, _ = _signatures(gf)[0]
+    return lambda: verify_uncompressed_signature(pk, sig, msg)
+
+@benchmark('verify.uncompressed.batch10')
+def _(gf):
+    items = [(pk, sig, msg) for pk,sig,_ in _signatures(gf)]
+    return lambda: verify_uncompressed_batch(items)
+
+@benchmark('verify.compressed')
+def _(gf):
+    pk, _, compressed = _signatures(gf)[0]
+    def verify():
+        basis_store.clear()
+        return verify_compressed_signature(pk, compressed, msg)
+    return verify
+
+@benchmark('verify.compressed.warm')
+def _(gf):
+    # the basis of the public key is in the store already
+    pk, _, compressed = _signatures(gf)[0]
+    basis_store.clear()
+    verify_compressed_signature(pk, compressed, msg)
+    return lambda: verify_compressed_signature(pk, compressed, msg)
+
+################################################################
+
+def _measure(gf, setup, repeat, min_time):
+    random.seed(0)
+    call = setup(gf)
+    gf.counts.clear()
+    call()
+    counts = dict(gf.counts)
+
+    # as many iterations as take min_time, like timeit's autorange
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        times.append((time.perf_counter() - start) / number)
+    return {'number': number,
+            'repeat': repeat,
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.fmean(times),
+            'stdev': statistics.stdev(times) if repeat > 1 else 0.,
+            'counts': counts,
+            'cost': gf.cost(counts)}
+
+def run(names=None, backend=None, repeat=5, min_time=.2, log=None):
+    # runs the benchmarks (all of them by default), and returns the
+    # results as a dictionary that is saved as JSON
+    gf = Field(p, backend)
+    results = {}
+    for name in names or benchmarks:
+        results[name] = _measure(gf, benchmarks[name], repeat, min_time)
+        if log is not None:
+            r = results[name]
+            print(f'{name:32} {1e6 * r["median"]:14.2f} µs ± {1e6 * r["stdev"]:10.2f}   cost {r["cost"]:12.2f}', file=log)
+    return {'meta': {'python': platform.python_version(),
+                     'machine': platform.machine(),
+                     'backend': gf.backend,
+                     'p': int(p),
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'repeat': repeat,
+                     'min_time': min_time},
+            'benchmarks': results}
+
+def compare(baseline, results, threshold=.1, cost_threshold=0.):
+    # returns a list of (name, time ratio, cost ratio, regressed)
+    # for the benchmarks in both, where a ratio is new / baseline
+    rows = []
+    for name, new in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        time_ratio = new['median'] / old['median']
+        if old['cost']:
+            cost_ratio = new['cost'] / old['cost']
+        else:
+            cost_ratio = float('inf') if new['cost'] else 1.
+        regressed = time_ratio > 1 + threshold or cost_ratio > 1 + cost_threshold
+        rows.append((name, time_ratio, cost_ratio, regressed))
+    return rows
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='bench.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+    runner = commands.add_parser('run', help='run the benchmarks')
+    runner.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    runner.add_argument('--output', help='file to save the results to, as JSON')
+    runner.add_argument('--repeat', type=int, default=5)
+    runner.add_argument('--min-time', type=float, default=.2, help='seconds per timing')
+    runner.add_argument('--backend', choices=sorted(Field.backends), default='gmpy2')
+    runner.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    comparer = commands.add_parser('compare', help='compare results with a baseline')
+    comparer.add_argument('baseline')
+    comparer.add_argument('results')
+    comparer.add_argument('--threshold', type=float, default=.1, help='tolerated growth of the median time')
+    comparer.add_argument('--cost-threshold', type=float, default=0., help='tolerated growth of Field.cost')
+    args = parser.parse_args(args)
+
+    if args.command == 'run':
+        if args.list:
+            print('\n'.join(benchmarks))
+            return 0
+        unknown = [name for name in args.names if name not in benchmarks]
+        if unknown:
+            parser.error(f'unknown benchmarks {", ".join(unknown)}')
+        results = run(args.names, args.backend, args.repeat, args.min_time, log=sys.stderr)
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump(results, fp, indent=2)
+        return 0
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    with open(args.results) as fp:
+        results = json.load(fp)
+    rows = compare(baseline, results, args.threshold, args.cost_threshold)
+    for name, time_ratio, cost_ratio, regressed in rows:
+        print(f'{name:32} time {time_ratio:7.3f}×   cost {cost_ratio:7.3f}×{"   REGRESSION" if regressed else ""}')
+    return int(any(regressed for *_, regressed in rows))
+
+################################################################
+
+import pytest
+
+class Test:
+    @staticmethod
+    def test_run():
+        names = ['field.mul', 'curve.xDBL', 'isogeny.four']
+        results = run(names, repeat=2, min_time=.001)
+        assert list(results['benchmarks']) == names
+        assert results['benchmarks']['field.mul']['counts'] == {'mul': 1}
+        assert results['benchmarks']['field.mul']['cost'] == 1
+        assert all(r['median'] > 0 for r in results['benchmarks'].values())
+        # the counts are reproducible
+        assert run(names, repeat=1, min_time=0)['benchmarks']['isogeny.four']['counts'] \
+                == results['benchmarks']['isogeny.four']['counts']
+        json.dumps(results)
+
+    @staticmethod
+    def test_verify_counts():
+        # the same work on every call, even where a store is involved
+        results = run(['verify.compressed', 'verify.compressed.warm'], repeat=1, min_time=0)['benchmarks']
+        gf = Field(p)
+        pk, _, compressed = _signatures(gf)[0]
+        basis_store.clear()
+        gf.counts.clear()
+        verify_compressed_signature(pk, compressed, msg)
+        assert results['verify.compressed']['cost'] == gf.cost()
+        assert results['verify.compressed.warm']['cost'] < gf.cost()
+
+    @staticmethod
+    def test_compare():
+        def results(median, cost):
+            return {'benchmarks': {'a': {'median': median, 'cost': cost}}}
+        assert compare(results(1., 10.), results(1.05, 10.)) == [('a', 1.05, 1., False)]
+        assert compare(results(1., 10.), results(1.2, 10.))[0][-1]
+        assert compare(results(1., 10.), results(.5, 10.5))[0][-1]
+        assert not compare(results(1., 10.), results(.5, 10.5), cost_threshold=.1)[0][-1]
+
+if __name__ == '__main__':
+    sys.exit(main())
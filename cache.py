@@ -0,0 +1,164 @@
+
+__all__ = ['VerificationCache']
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import time
+
+from field import FieldElement
+from sqisign import verify_uncompressed_signature, verify_compressed_signature
+
+# Remembers the verdicts of (pk, signature, message) triples, in an LRU
+# dictionary bounded in size and (optionally) in age, in front of an
+# optional file that survives restarts. The file is a memory-mapped,
+# direct-mapped table of fixed-size slots: a new verdict overwrites
+# whatever lives in its slot. Only verdicts are cached; signatures
+# on which verification raises are verified again every time.
+
+_slot = struct.Struct('<32sB7xd')       # digest, verdict + 1 (0: empty), time
+
+def _digest(pk, signature, message):
+    # sha256 of a canonical encoding: 32-byte little-endian integers
+    # for the field elements, and for the s of compressed blocks, which
+    # need not be in range yet, a length and that many bytes (signed)
+    element = lambda a: int(a.re).to_bytes(32, 'little') + int(a.im).to_bytes(32, 'little')
+    blocks, E1 = signature
+    h = hashlib.sha256()
+    h.update(element(pk) + element(E1) + len(blocks).to_bytes(4, 'little'))
+    for block in blocks:
+        if isinstance(block, FieldElement):
+            h.update(b'u' + element(block))
+        else:
+            swap, s = block
+            s = int(s).to_bytes(int(s).bit_length() // 8 + 1, 'little', signed=True)
+            h.update(b'c' + bytes([bool(swap)]) + len(s).to_bytes(4, 'little') + s)
+    h.update(message)
+    return h.digest()
+
+class VerificationCache:
+    def __init__(self, maxsize=4096, ttl=None, path=None, slots=1<<16):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.counts = collections.defaultdict(int)
+        self._entries = collections.OrderedDict()     # digest -> (verdict, time)
+        self._map = None
+        if path is not None:
+            with open(path, 'a+b') as fp:
+                if os.fstat(fp.fileno()).st_size != slots * _slot.size:
+                    fp.truncate(0)
+                    fp.truncate(slots * _slot.size)
+                self._map = mmap.mmap(fp.fileno(), 0)
+            self._slots = slots
+
+    def _fresh(self, stored):
+        return self.ttl is None or time.time() - stored < self.ttl
+
+    def _get(self, digest):
+        if digest in self._entries:
+            verdict, stored = self._entries[digest]
+            if self._fresh(stored):
+                self._entries.move_to_end(digest)
+                return verdict
+            del self._entries[digest]
+            self.counts['expired'] += 1
+        if self._map is not None:
+            offset = int.from_bytes(digest[:8], 'little') % self._slots * _slot.size
+            key, verdict, stored = _slot.unpack_from(self._map, offset)
+            if verdict and key == digest and self._fresh(stored):
+                self.counts['disk hits'] += 1
+                self._put(digest, bool(verdict - 1), stored, disk=False)
+                return bool(verdict - 1)
+        return None
+
+    def _put(self, digest, verdict, stored, disk=True):
+        self._entries[digest] = verdict, stored
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.counts['evictions'] += 1
+        if disk and self._map is not None:
+            offset = int.from_bytes(digest[:8], 'little') % self._slots * _slot.size
+            _slot.pack_into(self._map, offset, digest, verdict + 1, stored)
+
+    def verify(self, pk, signature, message):
+        digest = _digest(pk, signature, message)
+        verdict = self._get(digest)
+        if verdict is not None:
+            self.counts['hits'] += 1
+            return verdict
+        self.counts['misses'] += 1
+        blocks = signature[0]
+        if blocks and isinstance(blocks[0], FieldElement):
+            verdict = verify_uncompressed_signature(pk, signature, message)
+        else:
+            verdict = verify_compressed_signature(pk, signature, message)
+        self._put(digest, verdict, time.time())
+        return verdict
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+
+################################################################
+
+import pytest
+
+from field import Field
+from sqisign import p, msg
+
+class Test:
+    @staticmethod
+    def test_cache(tmp_path, monkeypatch):
+        from good_signatures import get_signatures
+        gf = Field(p)
+        sigs = get_signatures(gf.i())[:2]
+        (pk, sig, compressed), (pk2, sig2, _) = sigs
+
+        cache = VerificationCache(maxsize=2, ttl=60, path=tmp_path / 'cache')
+        assert cache.verify(pk, sig, msg)
+        assert not cache.verify(pk, sig, b'Goodbye, world!')
+        gf.counts.clear()
+        assert cache.verify(pk, sig, msg)
+        assert not cache.verify(pk, sig, b'Goodbye, world!')
+        assert not gf.counts            # no verification at all
+        assert cache.verify(pk, compressed, msg)
+        assert cache.verify(pk2, sig2, msg)
+        assert dict(cache.counts) == {'hits': 2, 'misses': 4, 'evictions': 2}
+        cache.close()
+
+        # the verdicts survive in the file
+        cache = VerificationCache(maxsize=2, ttl=60, path=tmp_path / 'cache')
+        gf.counts.clear()
+        assert not cache.verify(pk, sig, b'Goodbye, world!')
+        assert not gf.counts
+        assert cache.counts['disk hits'] == 1
+
+        # and expire
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + 61)
+        assert not cache.verify(pk, sig, b'Goodbye, world!')
+        assert gf.counts
+        assert cache.counts['expired'] == 1
+        cache.close()
+
+    @staticmethod
+    def test_malformed():
+        # s out of range reaches the verifier, which rejects it, and
+        # the verdict is cached like any other
+        from good_signatures import get_signatures
+        gf = Field(p)
+        pk, _, (blocks, E1) = get_signatures(gf.i())[0]
+        cache = VerificationCache()
+        for s in (-1, 2**128, 2**300):
+            assert not cache.verify(pk, (blocks[:-1] + [(False, s)], E1), msg)
+            assert not cache.verify(pk, (blocks[:-1] + [(False, s)], E1), msg)
+        assert dict(cache.counts) == {'misses': 3, 'hits': 3}
+        assert len({_digest(pk, ([(False, s)], E1), msg) for s in (-1, 255, 256, 2**128)}) == 4
@@ -0,0 +1,261 @@
+
+__all__ = ['Formula']
+
+import ast
+import collections
+
+from field import FieldElement
+from vector import FieldVector
+
+# A Formula is a straight-line computation on 𝔽p² elements, written once
+# in Python syntax, e.g.
+#
+#     Formula('xDBL', ('X', 'Z', 'A24', 'C24'), ('X2', 'Z2'), '''
+#         t0 = (X - Z)**2
+#         t1 = (X + Z)**2
+#         ...
+#     ''')
+#
+# Only +, -, unary -, * and **2 on variables and integer constants are
+# allowed. The body is turned into an expression graph with common
+# subexpressions merged, and then into a Python function that works on
+# the raw (re, im) integers: products are reduced mod p, sums are not
+# (they are reduced by whatever consumes them), and temporaries are
+# reused once they are dead. The operation counts are worked out at
+# generation time and added to Field.counts in one go, so they mean
+# exactly the same as for the FieldElement operators. Called on
+# FieldVectors, the same code computes the formula for all of them.
+
+class _Node:
+    __slots__ = ('op', 'args', 'value', 'reduced')
+
+    def __init__(self, op, args, value=None):
+        self.op = op            # 'in', 'const', 'add', 'sub', 'neg', 'mul', 'sq'
+        self.args = args
+        self.value = value      # input index or integer constant
+        self.reduced = op in ('in', 'mul', 'sq') or op == 'const' and 0 <= value
+
+class Formula:
+    def __init__(self, name, inputs, outputs, body):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self._nodes = []
+        self._cse = {}
+        self._outputs = self._parse(body)
+        self.counts = self._count()
+        self._compiled = {}
+
+    ################################################################
+
+    def _node(self, op, args=(), value=None):
+        if op in ('add', 'mul'):
+            args = tuple(sorted(args, key=id))     # commutative
+        key = (op, tuple(map(id, args)), value)
+        if key not in self._cse:
+            node = _Node(op, args, value)
+            self._cse[key] = node
+            self._nodes.append(node)
+        return self._cse[key]
+
+    def _parse(self, body):
+        env = {name: self._node('in', value=k) for k,name in enumerate(self.inputs)}
+        lines = [l.strip() for l in body.strip().splitlines()]
+        for stmt in ast.parse('\n'.join(l for l in lines if l)).body:
+            if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)):
+                raise SyntaxError(f'{self.name}: only simple assignments are allowed')
+            env[stmt.targets[0].id] = self._expr(stmt.value, env)
+        missing = [name for name in self.outputs if name not in env]
+        if missing:
+            raise SyntaxError(f'{self.name}: outputs {missing} are never assigned')
+        return [env[name] for name in self.outputs]
+
+    def _expr(self, e, env):
+        if isinstance(e, ast.Name):
+            if e.id not in env:
+                raise SyntaxError(f'{self.name}: unknown variable {e.id}')
+            return env[e.id]
+        if isinstance(e, ast.Constant) and type(e.value) is int:
+            return self._node('const', value=e.value)
+        if isinstance(e, ast.UnaryOp) and isinstance(e.op, ast.USub):
+            return self._node('neg', (self._expr(e.operand, env),))
+        if isinstance(e, ast.BinOp):
+            if isinstance(e.op, ast.Pow):
+                if not (isinstance(e.right, ast.Constant) and e.right.value == 2):
+                    raise SyntaxError(f'{self.name}: only squaring is allowed')
+                return self._node('sq', (self._expr(e.left, env),))
+            ops = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul'}
+            if type(e.op) in ops:
+                return self._node(ops[type(e.op)], (self._expr(e.left, env), self._expr(e.right, env)))
+        raise SyntaxError(f'{self.name}: unsupported expression {ast.unparse(e)}')
+
+    def _live(self):
+        # the nodes the outputs depend on, in evaluation order
+        live = set()
+        todo = list(self._outputs)
+        while todo:
+            node = todo.pop()
+            if id(node) not in live:
+                live.add(id(node))
+                todo += node.args
+        return [node for node in self._nodes if id(node) in live]
+
+    def _count(self):
+        # the same as the FieldElement operators: products with constants
+        # count as multiplications, negations are free
+        counts = collections.Counter()
+        for node in self._live():
+            if node.op in ('add', 'sub'):
+                counts['add'] += 1
+            elif node.op in ('mul', 'sq'):
+                counts[node.op] += 1
+        return dict(counts)
+
+    ################################################################
+
+    def source(self, karatsuba=False, vector=False):
+        nodes = self._live()
+        last = {}
+        for k,node in enumerate(nodes):
+            for arg in node.args:
+                last[id(arg)] = k
+        for node in self._outputs:
+            last[id(node)] = len(nodes)
+
+        names = {}
+        free = []
+        fresh = iter(range(len(nodes)))
+        # a vector kernel takes the number of elements n, its inputs
+        # may be vectors or single elements, its outputs are vectors
+        lines = [f'def {self.name}(gf, {"n, " if vector else ""}{", ".join(self.inputs)}):',
+                 f'    p = gf.p',
+                 f'    counts = gf.counts']
+        lines += [f'    counts[{k!r}] += {c}{" * n" if vector else ""}' for k,c in sorted(self.counts.items())]
+        new = 'FieldVector._full(gf, n, ' if vector else 'FieldElement._new(gf, '
+
+        def re(node): return str(node.value) if node.op == 'const' else names[id(node)] + '_re'
+        def im(node): return '0' if node.op == 'const' else names[id(node)] + '_im'
+
+        for k,node in enumerate(nodes):
+            if node.op == 'const':
+                continue
+            if node.op == 'in':
+                names[id(node)] = f'v{next(fresh)}'
+                x = self.inputs[node.value]
+                lines.append(f'    {re(node)}, {im(node)} = {x}.re, {x}.im')
+                continue
+
+            args = node.args
+            # operands that die here free their names for the result
+            for arg in args:
+                if arg.op != 'const' and last[id(arg)] == k and names[id(arg)] not in free:
+                    free.append(names[id(arg)])
+            names[id(node)] = free.pop() if free else f'v{next(fresh)}'
+            r, i = re(node), im(node)
+
+            if node.op == 'add':
+                a, b = args
+                lines.append(f'    {r}, {i} = {re(a)} + {re(b)}, {im(a)} + {im(b)}')
+            elif node.op == 'sub':
+                a, b = args
+                lines.append(f'    {r}, {i} = {re(a)} - {re(b)}, {im(a)} - {im(b)}')
+            elif node.op == 'neg':
+                a, = args
+                lines.append(f'    {r}, {i} = -{re(a)}, -{im(a)}')
+            elif node.op == 'sq':
+                a, = args
+                lines.append(f'    {r}, {i} = ({re(a)} + {im(a)}) * ({re(a)} - {im(a)}) % p, 2 * {re(a)} * {im(a)} % p')
+            elif any(arg.op == 'const' for arg in args):
+                c, a = args if args[0].op == 'const' else args[::-1]
+                lines.append(f'    {r}, {i} = {re(a)} * {c.value} % p, {im(a)} * {c.value} % p')
+            elif karatsuba:
+                a, b = args
+                lines.append(f'    t, u = {re(a)} * {re(b)}, {im(a)} * {im(b)}')
+                lines.append(f'    {r}, {i} = (t - u) % p, (({re(a)} + {im(a)}) * ({re(b)} + {im(b)}) - t - u) % p')
+            else:
+                a, b = args
+                lines.append(f'    {r}, {i} = ({re(a)} * {re(b)} - {im(a)} * {im(b)}) % p, ({re(a)} * {im(b)} + {im(a)} * {re(b)}) % p')
+
+        rets = []
+        for node in self._outputs:
+            if node.op == 'const':
+                rets.append(f'{new}{node.value} % p, 0)')
+            elif node.reduced:
+                rets.append(f'{new}{re(node)}, {im(node)})')
+            else:
+                rets.append(f'{new}{re(node)} % p, {im(node)} % p)')
+        lines.append(f'    return {", ".join(rets)}' + (',' if len(rets) == 1 else ''))
+        return '\n'.join(lines) + '\n'
+
+    def _compile(self, karatsuba, vector):
+        namespace = {}
+        exec(compile(self.source(karatsuba, vector), f'<formula {self.name}>', 'exec'),
+             {'FieldElement': FieldElement, 'FieldVector': FieldVector}, namespace)
+        return namespace[self.name]
+
+    def __call__(self, gf, *args):
+        # args are FieldElements of gf, returns a tuple of FieldElements
+        try:
+            f = self._compiled[gf._karatsuba, False]
+        except KeyError:
+            f = self._compiled[gf._karatsuba, False] = self._compile(gf._karatsuba, False)
+        return f(gf, *args)
+
+    def vector(self, gf, *args):
+        # args are FieldVectors of the same length or FieldElements,
+        # returns a tuple of FieldVectors
+        n = next(len(a) for a in args if isinstance(a, FieldVector))
+        key = gf._karatsuba, True
+        if key not in self._compiled:
+            self._compiled[key] = self._compile(*key)
+        return self._compiled[key](gf, n, *args)
+
+    def __repr__(self):
+        return f'Formula {self.name}({", ".join(self.inputs)}) -> {", ".join(self.outputs)}'
+
+################################################################
+
+import pytest
+import random
+
+from field import Field
+
+class Test:
+    @staticmethod
+    def test_formula():
+        gf = Field(2**127 - 1)
+        F = Formula('f', ('a', 'b', 'c'), ('x', 'y', 'z'), '''
+            t = (a + b) * c
+            u = (a + b) * c - a**2
+            x = t * u + 3 * t
+            y = -(c - b)**2
+            z = 7
+        ''')
+        assert F.counts == {'add': 4, 'mul': 3, 'sq': 2}   # (a+b)*c only once
+        a, b, c = gf.random(), gf.random(), gf.random()
+        t = (a + b) * c
+        u = t - a**2
+        expected = (t * u + 3 * t, -(c - b)**2, gf(7))
+        for karatsuba in (False, True):
+            gf._karatsuba = karatsuba
+            gf.counts.clear()
+            assert F(gf, a, b, c) == expected
+            assert dict(gf.counts) == F.counts
+
+            u = FieldVector(gf, [a, b, c])
+            gf.counts.clear()
+            x, y, z = F.vector(gf, u, b, c)
+            assert (x[0], y[0], z[0]) == expected
+            assert list(z) == [7] * 3
+            assert dict(gf.counts) == {k: 3*c for k,c in F.counts.items()}
+
+    @staticmethod
+    def test_syntax():
+        with pytest.raises(SyntaxError):
+            Formula('f', ('a',), ('x',), 'x = a / a')
+        with pytest.raises(SyntaxError):
+            Formula('f', ('a',), ('x',), 'x = a**3')
+        with pytest.raises(SyntaxError):
+            Formula('f', ('a',), ('x',), 'x = b')
+        with pytest.raises(SyntaxError):
+            Formula('f', ('a',), ('x', 'y'), 'x = a')
@@ -0,0 +1,9 @@
+import pytest
+
+from field import Field
+
+# run every test against each arithmetic backend of Field
+@pytest.fixture(autouse=True, params=sorted(Field.backends))
+def field_backend(request, monkeypatch):
+    monkeypatch.setattr(Field, 'default_backend', request.param)
+    return request.param
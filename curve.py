@@ -1,31 +1,132 @@
-
-__all__ = ['Curve']
+__all__ = ['Curve', 'normalize_all']
 
 from field import Field, FieldElement
+from compiler import Formula
+
+# the x-only formulas, on the projective (A24 : C24) = (A+2C : 4C)
+# or on the affine a24 = (A+2)/4; P, Q and P-Q are (X2:Z2), (X3:Z3), (X1:Z1)
+
+_xDBL = Formula('xDBL', ('X2', 'Z2', 'A24', 'C24'), ('X4', 'Z4'), '''
+    t0 = (X2 - Z2)**2
+    t1 = (X2 + Z2)**2
+    Z4 = C24 * t0
+    X4 = Z4 * t1
+    t1 = t1 - t0
+    Z4 = (Z4 + A24 * t1) * t1
+''')
+
+_xADD = Formula('xADD', ('X2', 'Z2', 'X3', 'Z3', 'X1', 'Z1'), ('X5', 'Z5'), '''
+    t0 = (X3 - Z3) * (X2 + Z2)
+    t1 = (X3 + Z3) * (X2 - Z2)
+    X5 = Z1 * (t0 + t1)**2
+    Z5 = X1 * (t0 - t1)**2
+''')
+
+_xDBL_affine = Formula('xDBL_affine', ('X2', 'Z2', 'a24'), ('X4', 'Z4'), '''
+    t0 = (X2 - Z2)**2
+    t1 = (X2 + Z2)**2
+    X4 = t0 * t1
+    t1 = t1 - t0
+    Z4 = (t0 + a24 * t1) * t1
+''')
+
+_xDBLADD_body = '''
+    s = X2 + Z2
+    d = X2 - Z2
+    ss = s**2
+    dd = d**2
+    t = ss - dd
+    X4 = ss * dd
+    Z4 = (dd + a24 * t) * t
+    t0 = (X3 - Z3) * s
+    t1 = (X3 + Z3) * d
+    Z5 = X1 * (t0 - t1)**2
+'''
+_xDBLADD = Formula('xDBLADD', ('X2', 'Z2', 'X3', 'Z3', 'X1', 'Z1', 'a24'), ('X4', 'Z4', 'X5', 'Z5'),
+                   _xDBLADD_body + 'X5 = Z1 * (t0 + t1)**2')
+_xDBLADD_affine = Formula('xDBLADD_affine', ('X2', 'Z2', 'X3', 'Z3', 'X1', 'a24'), ('X4', 'Z4', 'X5', 'Z5'),
+                          _xDBLADD_body + 'X5 = (t0 + t1)**2')
 
 class Curve:
-    def __init__(self, A):
+    # curves are stored projectively as (A24 : C24) = (A+2C : 4C),
+    # which is exactly what the x-only formulas and 2-isogenies need,
+    # so no inversions are necessary when walking through the graph
+    def __init__(self, A, C=1):
         if not isinstance(A, FieldElement):
             raise ValueError('not a field element')
-        if A == 2 or A == -2:
+        C = A.gf(C)
+        self._A = A if C == 1 else None
+        C2 = C + C
+        self._set(A + C2, C2 + C2)
+
+    @classmethod
+    def _from_A24(cls, A24, C24):
+        E = cls.__new__(cls)
+        E._A = None
+        E._set(A24, C24)
+        return E
+
+    def _set(self, A24, C24):
+        if not C24:
+            raise ValueError('projective curve (A:0) is invalid')
+        if not A24 or A24 == C24:     # A == -2C or A == 2C
             raise ValueError('this curve is singular')
-        self.A = A
+        self.A24 = A24
+        self.C24 = C24
+        self.gf = A24.gf
+        self._a24 = None
+
+    @property
+    def A(self):
+        # the affine coefficient, only computed (at the cost of
+        # an inversion) when someone actually asks for it, and
+        # from a24 = (A+2)/4 if that is known already
+        if self._A is None:
+            if self._a24 is not None:
+                self._A = 4*self._a24 - 2
+            else:
+                self._A = 4*self.A24 / self.C24 - 2
+        return self._A
+
+    @property
+    def a24(self):
+        # the affine (A+2)/4, worth an inversion for the ladders,
+        # which do hundreds of doublings on the same curve
+        if self._a24 is None:
+            if self.C24 == 4:
+                self._a24 = self.A24 * self.gf._inverse(4)
+            elif self._A is not None:
+                self._a24 = (self._A + 2) * self.gf._inverse(4)
+            else:
+                self._a24 = self.A24 / self.C24
+        return self._a24
 
     def __repr__(self):
-        if not self.A:
+        A = self.A
+        if not A:
             return 'y² = x³ + x'
-        if self.A == 1:
+        if A == 1:
             return 'y² = x³ + x² + x'
-        return f'y² = x³ + {self.A}x² + x'
+        return f'y² = x³ + {A}x² + x'
 
     def __eq__(self, other):
         if not isinstance(other, Curve):
             return NotImplemented
-        return self.A == other.A
+        if self is other:
+            return True
+        return self.A24 * other.C24 == other.A24 * self.C24
 
     def __call__(self, *args, **kwds):
         return KummerPoint(self, *args, **kwds)
 
+    def to_bytes(self):
+        # the affine coefficient A, see FieldElement.to_bytes
+        return self.A.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, gf, data, offset=0):
+        return cls(gf.from_bytes(data, offset))
+
     def zero(self):
         return self()
 
@@ -34,45 +135,66 @@ class Curve:
             raise TypeError('not a point')
         if P.E != self:
             raise ValueError('not a point on this curve')
-        a = self.A
-        X1, Z1 = P.x, P.z
-
-        # TODO: Hey there! Please implement some nice formulas here :-)
-
-        return # some nice X and Z coordinate here
+        X2, Z2 = _xDBL(self.gf, P.x, P.z, self.A24, self.C24)
+        return KummerPoint._new(self, X2, Z2)
 
     def xADD(self, P, Q, PQ):
         if not (isinstance(P, KummerPoint) and isinstance(Q, KummerPoint) and isinstance(PQ, KummerPoint)):
             raise TypeError('not a point')
         if not P.E == Q.E == PQ.E == self:
             raise ValueError('not a point on this curve')
-        X2, Z2 = P.x, P.z
-        X3, Z3 = Q.x, Q.z
-        X1, Z1 = PQ.x, PQ.z
-
-        # TODO: Hey there! Please implement some nice formulas here :-)
+        X5, Z5 = _xADD(self.gf, P.x, P.z, Q.x, Q.z, PQ.x, PQ.z)
+        return KummerPoint._new(self, X5, Z5)
 
-        return # some nice X and Z coordinate here
+    def xDBLADD(self, P, Q, PQ):
+        # returns [2]P and P+Q, sharing the sums and differences of P
+        if not (isinstance(P, KummerPoint) and isinstance(Q, KummerPoint) and isinstance(PQ, KummerPoint)):
+            raise TypeError('not a point')
+        if not P.E == Q.E == PQ.E == self:
+            raise ValueError('not a point on this curve')
+        if PQ.z.re == 1 and not PQ.z.im:
+            X4, Z4, X5, Z5 = _xDBLADD_affine(self.gf, P.x, P.z, Q.x, Q.z, PQ.x, self.a24)
+        else:
+            X4, Z4, X5, Z5 = _xDBLADD(self.gf, P.x, P.z, Q.x, Q.z, PQ.x, PQ.z, self.a24)
+        return KummerPoint._new(self, X4, Z4), KummerPoint._new(self, X5, Z5)
 
     def is_x_coordinate(self, x):
-        return (x * (1 + x * (self.A + x))).is_square()
+        # x³ + Ax² + x is a square iff C·x·(Cx² + Ax + C) is,
+        # where (A : C) = (4·A24 - 2·C24 : C24)
+        if self._A is not None:
+            return (x * (1 + x * (self._A + x))).is_square()
+        A, C = 4*self.A24 - 2*self.C24, self.C24
+        return (C * x * (C + x * (A + C * x))).is_square()
 
     def random(self):
         while True:
-            x = self.A.gf.random()
+            x = self.gf.random()
             if self.is_x_coordinate(x):
                 return self(x)
 
 class KummerPoint:
+    __slots__ = ('E', 'x', 'z')
+
     def __init__(self, E, x, z=1):
         assert isinstance(E, Curve)
-        x,z = map(E.A.gf, (x,z))
+        x,z = map(E.gf, (x,z))
         if not x and not z:
             raise ValueError('projective point (0:0) is invalid')
         self.E = E
         self.x = x
         self.z = z
 
+    @classmethod
+    def _new(cls, E, x, z):
+        # trusted constructor: x and z must be elements of E's field
+        if not x and not z:
+            raise ValueError('projective point (0:0) is invalid')
+        ret = object.__new__(cls)
+        ret.E = E
+        ret.x = x
+        ret.z = z
+        return ret
+
     def __repr__(self):
         x, z = self.x, self.z
         if not z:
@@ -83,7 +205,7 @@ class KummerPoint:
         return f'Kummer point ({x}:{z})'
 
     def _scale(self, s):
-        one = self.E.A.gf.one()
+        one = self.E.gf.one()
         self.x = one if self.x == s else self.x * s
         self.z = one if self.z == s else self.z * s
 
@@ -100,17 +222,75 @@ class KummerPoint:
     def __bool__(self):
         return bool(self.z)
 
+    # the affine x as a field element, or 0xff…ff (which is not a
+    # reduced field element) for the point at infinity
+
+    def to_bytes(self):
+        if not self.z:
+            return b'\xff' * (2 * self.E.gf.nbytes)
+        return (self.x / self.z).to_bytes()
+
+    @classmethod
+    def from_bytes(cls, E, data, offset=0):
+        n = 2 * E.gf.nbytes
+        if memoryview(data)[offset:offset+n] == b'\xff' * n:
+            return E(1, 0)
+        return E(E.gf.from_bytes(data, offset))
+
+    def double_k(self, k, intermediates=False):
+        # [2^k]P by k doublings on the affine a24, which is cheaper than
+        # the ladder; with intermediates=True, returns [P, 2P, ..., 2^k P]
+        E = self.E
+        a24 = E.a24
+        X, Z = self.x, self.z
+        points = [self]
+        for _ in range(k):
+            X, Z = _xDBL_affine(E.gf, X, Z, a24)
+            if intermediates:
+                points.append(KummerPoint._new(E, X, Z))
+        if intermediates:
+            return points
+        return KummerPoint._new(E, X, Z) if k else self
+
+    def has_exact_order_2k(self, k):
+        # whether P has order exactly 2^k
+        if not k:
+            return not self
+        T = self.double_k(k - 1)
+        return bool(T) and not T.E.xDBL(T)
+
     def __mul__(self, other):
         if not self.z:
             return self
         n = abs(int(other))
-        R0 = self.E(1, 0)
-        R1 = self
-        for k in reversed(range(n.bit_length())):
-            # TODO: Hey there! Please implement a nice Montgomery ladder here :-)
-        return R0
+        if not self.x:      # the point (0,0) has order 2
+            return self if n & 1 else self.E(1, 0)
+        if not n:
+            return self.E(1, 0)
+        # the factor 2^k of n by doublings, the odd part by the ladder
+        k = (n & -n).bit_length() - 1
+        n >>= k
+        R0 = self
+        if n > 1:
+            R0 = self.E(1, 0)
+            R1 = self
+            for i in reversed(range(n.bit_length())):
+                if n >> i & 1:
+                    R1, R0 = self.E.xDBLADD(R1, R0, self)
+                else:
+                    R0, R1 = self.E.xDBLADD(R0, R1, self)
+        return R0.double_k(k)
     __rmul__ = __mul__
 
+def normalize_all(points):
+    # KummerPoint._normalize for all points at once, with a single inversion
+    points = [P for P in points if not (P.z == 1 or not P.z and P.x == 1)]
+    if not points:
+        return
+    gf = points[0].E.gf
+    for P, s in zip(points, gf.batch_invert(P.z or P.x for P in points)):
+        P._scale(s)
+
 ################################################################
 
 import pytest
@@ -130,6 +310,10 @@ class Test:
         S = E(1665137133, 121917320)
         assert E.xADD(P, Q, PQ) == S
 
+        assert E.xDBLADD(P, Q, PQ) == (R, S)
+        F = Curve(gf(42 * 5), gf(5))
+        assert F.xDBLADD(F(P.x, P.z), F(Q.x, Q.z), F(PQ.x, PQ.z)) == (F(R.x, R.z), F(S.x, S.z))
+
     @staticmethod
     def test_ladder():
         gf = Field(2**31 - 1)
@@ -143,6 +327,68 @@ class Test:
         assert b * (a * P) == a * (b * P)
         assert a * (b * P) == (a * b) * P
 
+    @staticmethod
+    def test_double_k():
+        gf = Field(2**31 - 1)
+        E = Curve(gf(0))
+        P = E(7, 1)
+        points = [P]
+        for _ in range(5):
+            points.append(E.xDBL(points[-1]))
+        assert P.double_k(5, intermediates=True) == points == [2**k * P for k in range(6)]
+        assert P.double_k(5) == points[-1]
+        K = E(23, 1)
+        assert K.has_exact_order_2k(29)
+        assert not K.has_exact_order_2k(28)
+        assert not K.has_exact_order_2k(30)
+        assert (2**29 * K).has_exact_order_2k(0)
+        for k in (28, 29, 30):
+            assert K.has_exact_order_2k(k) == (not 2**k * K and bool(2**(k-1) * K))
+        n = random.randrange(2**99)
+        assert (n << 7) * P == (n * P).double_k(7) == 2**7 * (n * P)
+        assert (3 << 7) * P == E.xADD(2 * P, P, P).double_k(7)
+
+    @staticmethod
+    def test_bytes():
+        gf = Field(2**61 - 1)
+        E = Curve(gf(42) * 5, gf(5))
+        assert Curve.from_bytes(gf, E.to_bytes()) == E
+        for P in (E(1463231399, 340844173), E(1, 0), E(0, 1)):
+            assert KummerPoint.from_bytes(E, P.to_bytes()) == P
+
+    @staticmethod
+    def test_projective():
+        gf = Field(2**61 - 1)
+        A = gf(42)
+        C = gf(1234567, 89)
+        E = Curve(A)
+        F = Curve(A * C, C)
+        assert E == F
+        assert F.A == A
+        assert E != Curve(gf(43))
+        P = E(1463231399, 340844173)
+        assert E.xDBL(P) == F.xDBL(F(P.x, P.z))
+        # A and a24 share one inversion, whichever comes first
+        for first, second in (('A', 'a24'), ('a24', 'A')):
+            F = Curve(A * C, C)
+            gf.counts.clear()
+            getattr(F, first), getattr(F, second)
+            assert gf.counts['inv'] == 1
+            assert F.A == A and F.a24 == E.a24
+
+    @staticmethod
+    def test_normalize_all():
+        gf = Field(2**31 - 1)
+        E = Curve(gf(42))
+        points = [E.random() * random.randrange(1, 2**20) for _ in range(5)] + [E(0, 1), E(1, 0), E(7, 0)]
+        expected = [E(P.x, P.z) for P in points]
+        for P in expected:
+            P._normalize()
+        gf.counts.clear()
+        normalize_all(points)
+        assert gf.counts['inv'] == 1
+        assert [(P.x, P.z) for P in points] == [(P.x, P.z) for P in expected]
+
     @staticmethod
     def test_curve25519():
         ... #TODO
@@ -1,38 +1,73 @@
 
 __all__ = ['Field']
 
-import copy
 import collections
 import random
 import gmpy2
 
 class Field:
-    def __init__(self, p):
+    # the coefficients are Python ints ('int', the reference)
+    # or gmpy2 integers ('gmpy2', faster for large p)
+    backends = {
+            'int': int,
+            'gmpy2': gmpy2.mpz,
+        }
+    default_backend = 'int'
+
+    def __init__(self, p, backend=None):
         p = int(p)
         if not gmpy2.is_prime(p):
             raise ValueError('p must be a prime integer')
         if p % 4 != 3:
             raise NotImplementedError('p must be congruent to 3 modulo 4')
+        if backend is None:
+            backend = Field.default_backend
+        if backend not in Field.backends:
+            raise ValueError(f'unknown backend {backend!r}')
+        self.backend = backend
+        # Karatsuba saves a big multiplication per product, which pays off
+        # for Python ints, but not for gmpy2, whose multiplications are cheap
+        self._karatsuba = backend == 'int'
+        self._product = _karatsuba if self._karatsuba else _schoolbook
+        self._int = Field.backends[backend]
+        p = self._int(p)
         self.p = p
+        self.nbytes = (int(p).bit_length() + 7) // 8       # per coefficient
         self.counts = collections.defaultdict(int)
-
-    def cost(self):
-        # these are very rough approximations of the relative costs
-        # the actual cost always depends on implementation specifics
-        # results are scaled so that a multiplication costs 1 unit
-        weights = {
-                'mul': 1.,
-                'sq': .8,
-                'inv': 95.,
-                'issq': 110.,
-                'sqrt': 800.,
-                'add': 0.05,
-            }
-        return sum(weights[k]*c for k,c in self.counts.items())
+        # exponents and their addition chains for square roots
+        self._e1 = (p - 1) // 2
+        self._e2 = (p + 1) // 4
+        self._chains = {}
+
+    # these are very rough approximations of the relative costs
+    # the actual cost always depends on implementation specifics
+    # results are scaled so that a multiplication costs 1 unit
+    weights = {
+            'mul': 1.,
+            'sq': .8,
+            'inv': 95.,
+            'issq': 110.,
+            'sqrt': 800.,
+            'add': 0.05,
+        }
+
+    def cost(self, counts=None):
+        if counts is None:
+            counts = self.counts
+        return sum(self.weights[k]*c for k,c in counts.items())
 
     def __repr__(self):
         return f'𝔽{self.p}[√-1]'
 
+    def _inverse(self, s):
+        # inverse of an integer modulo p
+        if self.backend == 'gmpy2':
+            return gmpy2.invert(s, self.p)     # raises ZeroDivisionError
+        try:
+            return pow(s, -1, self.p)
+        except ValueError:
+            raise ZeroDivisionError
+
     def __eq__(self, other):
         if not isinstance(other, Field):
             return NotImplemented
@@ -44,7 +79,7 @@ class Field:
 
     def __call__(self, *args, **kwds):
         if len(args) == 1 and isinstance(args[0], FieldElement):
-            if args[0].gf != self:
+            if args[0].gf is not self and args[0].gf != self:
                 raise TypeError('element is not in this field')
             return args[0]
         return FieldElement(self, *args, **kwds)
@@ -52,6 +87,73 @@ class Field:
     def zero(self):
         return self()
 
+    # raw arithmetic on reduced (re, im) pairs, for the exponentiations
+    # inside .sqrt(), which are not counted as individual operations
+
+    def _mul(self, a, b):
+        p = self.p
+        re, im = self._product(a[0], a[1], b[0], b[1])
+        return re % p, im % p
+
+    def _sq(self, a):
+        p = self.p
+        return (a[0] + a[1]) * (a[0] - a[1]) % p, 2*a[0]*a[1] % p
+
+    def _chain(self, e, w=5):
+        # a sliding-window addition chain for e, computed once per exponent:
+        # a list of (number of squarings, odd window value) pairs
+        if e not in self._chains:
+            chain = []
+            i = e.bit_length() - 1
+            squarings = 0
+            while i >= 0:
+                if not e >> i & 1:
+                    squarings += 1
+                    i -= 1
+                    continue
+                j = max(i - w + 1, 0)
+                while not e >> j & 1:
+                    j += 1
+                chain.append((squarings + i - j + 1, e >> j & (1 << i - j + 1) - 1))
+                squarings = 0
+                i = j - 1
+            self._chains[e] = chain, squarings
+        return self._chains[e]
+
+    def _pow(self, a, e):
+        if not e:
+            return 1, 0
+        chain, tail = self._chain(e)
+        a2 = self._sq(a)
+        odd = [a]
+        for _ in range(max(v for _,v in chain) // 2):
+            odd.append(self._mul(odd[-1], a2))
+        r = None
+        for squarings, v in chain:
+            if r is not None:
+                for _ in range(squarings):
+                    r = self._sq(r)
+                r = self._mul(r, odd[v // 2])
+            else:
+                r = odd[v // 2]
+        for _ in range(tail):
+            r = self._sq(r)
+        return r
+
+    def from_bytes(self, data, offset=0):
+        # the element at data[offset:], as written by FieldElement.to_bytes;
+        # data can be anything with the buffer protocol (bytes, mmap, ...),
+        # and is read through a memoryview, without copying it
+        n = self.nbytes
+        data = memoryview(data)
+        if len(data) < offset + 2*n:
+            raise ValueError('not enough data for a field element')
+        re = int.from_bytes(data[offset:offset+n], 'little')
+        im = int.from_bytes(data[offset+n:offset+2*n], 'little')
+        if re >= self.p or im >= self.p:
+            raise ValueError('not a reduced field element')
+        return FieldElement._new(self, self._int(re), self._int(im))
+
     def one(self):
         return self(1)
 
@@ -61,12 +163,56 @@ class Field:
     def random(self):
         return self(random.randrange(self.p), random.randrange(self.p))
 
+    def batch_invert(self, elements):
+        # Montgomery's trick: one inversion and 3(N-1) multiplications
+        elements = [self(a) for a in elements]
+        if not elements:
+            return []
+        prefix = [elements[0]]
+        for a in elements[1:]:
+            prefix.append(prefix[-1] * a)
+        s = ~prefix[-1]         # raises ZeroDivisionError if any of them is zero
+        ret = [None] * len(elements)
+        for k in reversed(range(1, len(elements))):
+            ret[k] = s * prefix[k-1]
+            s = s * elements[k]
+        ret[0] = s
+        return ret
+
+def _schoolbook(a, b, c, d):
+    # (a + bi)(c + di), unreduced
+    return a*c - b*d, a*d + b*c
+
+def _karatsuba(a, b, c, d):
+    # (a + bi)(c + di) with three multiplications, unreduced
+    ac = a*c
+    bd = b*d
+    return ac - bd, (a + b) * (c + d) - ac - bd
+
 class FieldElement:
+    __slots__ = ('gf', 're', 'im')
+
     def __init__(self, gf, re=0, im=0):
         assert isinstance(gf, Field)
         self.gf = gf
-        self.re = int(re) % gf.p
-        self.im = int(im) % gf.p
+        self.re = gf._int(re) % gf.p
+        self.im = gf._int(im) % gf.p
+
+    @classmethod
+    def _new(cls, gf, re, im):
+        # trusted constructor: re and im must already be reduced mod p
+        ret = object.__new__(cls)
+        ret.gf = gf
+        ret.re = re
+        ret.im = im
+        return ret
+
+    def _coerce(self, other):
+        if not isinstance(other, FieldElement):
+            return self.gf(other)
+        if other.gf is not self.gf and other.gf != self.gf:
+            raise TypeError('trying to combine elements of distinct fields')
+        return other
 
     def __repr__(self):
         if not self.im:
@@ -80,42 +226,57 @@ class FieldElement:
     def __eq__(self, other):
         if not isinstance(other, FieldElement):
             other = self.gf(other)
-        if other.gf != self.gf:
+        if other.gf is not self.gf and other.gf != self.gf:
             raise TypeError('trying to compare elements of distinct fields')
         return self.re == other.re and self.im == other.im
 
     def __bool__(self):
         return bool(self.re or self.im)
 
+    def to_bytes(self):
+        # the real and the imaginary part, little-endian, gf.nbytes each
+        n = self.gf.nbytes
+        return int(self.re).to_bytes(n, 'little') + int(self.im).to_bytes(n, 'little')
+
     def __neg__(self):
-        return self.gf(-self.re, -self.im)
+        p = self.gf.p
+        return FieldElement._new(self.gf, -self.re % p, -self.im % p)
 
     def __add__(self, other):
-        self.gf.counts['add'] += 1
-        if not isinstance(other, FieldElement):
-            other = self.gf(other)
-        if other.gf != self.gf:
-            raise TypeError('trying to add elements of distinct fields')
-        return self.gf(self.re + other.re, self.im + other.im)
+        gf = self.gf
+        gf.counts['add'] += 1
+        other = self._coerce(other)
+        p = gf.p
+        return FieldElement._new(gf, (self.re + other.re) % p, (self.im + other.im) % p)
     __radd__ = __add__
 
+    def __sub__(self, other):
+        gf = self.gf
+        gf.counts['add'] += 1
+        other = self._coerce(other)
+        p = gf.p
+        return FieldElement._new(gf, (self.re - other.re) % p, (self.im - other.im) % p)
+    def __rsub__(self, other):
+        return (-self) + other
+
     def __mul__(self, other):
-        self.gf.counts['mul'] += 1
-        if not isinstance(other, FieldElement):
-            other = self.gf(other)
-        if other.gf != self.gf:
-            raise TypeError('trying to multiply elements of distinct fields')
-        return self.gf(self.re * other.re - self.im * other.im, self.re * other.im + self.im * other.re)
+        gf = self.gf
+        gf.counts['mul'] += 1
+        other = self._coerce(other)
+        p = gf.p
+        a, b, c, d = self.re, self.im, other.re, other.im
+        if gf._karatsuba:
+            ac, bd = a*c, b*d
+            return FieldElement._new(gf, (ac - bd) % p, ((a + b) * (c + d) - ac - bd) % p)
+        return FieldElement._new(gf, (a*c - b*d) % p, (a*d + b*c) % p)
     __rmul__ = __mul__
 
     def _square(self):
-        self.gf.counts['sq'] += 1
-        return self.gf(self.re**2 - self.im**2, 2*self.re*self.im)
-
-    def __sub__(self, other):
-        return self + (-other)
-    def __rsub__(self, other):
-        return (-self) + other
+        gf = self.gf
+        gf.counts['sq'] += 1
+        p = gf.p
+        a, b = self.re, self.im
+        return FieldElement._new(gf, (a + b) * (a - b) % p, 2*a*b % p)
 
     def __truediv__(self, other):
         if not isinstance(other, FieldElement):
@@ -127,14 +288,11 @@ class FieldElement:
         return ~self * other
 
     def __invert__(self):
-        self.gf.counts['inv'] += 1
-        s2 = self.re**2 + self.im**2
-        try:
-            s = pow(s2, -1, self.gf.p)
-        except ValueError:
-            raise ZeroDivisionError
-        ret = self.gf(self.re * s, -self.im * s)
-        return ret
+        gf = self.gf
+        gf.counts['inv'] += 1
+        p = gf.p
+        s = gf._inverse(self.re**2 + self.im**2)
+        return FieldElement._new(gf, self.re * s % p, -self.im * s % p)
 
     def __pow__(self, e):
         if e == 1:  # nop
@@ -149,36 +307,38 @@ class FieldElement:
         t = self
         while e:
             if e & 1:
-                r *= t
-            t *= t
+                r = r * t
+            t = t * t
             e >>= 1
         return r
 
     def sqrt(self):
-        # https://ia.cr/2012/685 equation (7)
+        # https://ia.cr/2012/685 equation (7), with a = self:
+        # b = a^((p-3)/4) gives a^((p+1)/4) = ab and a^((p-1)/2) = ab²,
+        # so only (1 + a^((p-1)/2))^((p-1)/2) needs a second exponentiation
         self.gf.counts['sqrt'] += 1
-        _counts = copy.copy(self.gf.counts)
-        e1 = (self.gf.p - 1) // 2
-        e2 = (self.gf.p + 1) // 4
-        if self**e1 == -1:
-            u = self.gf.i()
-        else:
-            u = (1 + self**e1)**e1
-        ret = u * self**e2
-        if ret**2 != self:
+        if not self:
+            return self.gf.zero()
+        if not self._is_square():
             raise ArithmeticError('not a square')
-        self.gf.counts = _counts
-        return ret
+        gf = self.gf
+        a = self.re, self.im
+        b = gf._pow(a, gf._e2 - 1)
+        ab = gf._mul(a, b)
+        c = gf._mul(ab, b)
+        if c == (gf.p - 1, 0):
+            u = 0, 1
+        else:
+            u = gf._pow(((c[0] + 1) % gf.p, c[1]), gf._e1)
+        return FieldElement(gf, *gf._mul(u, ab))
+
+    def _is_square(self):
+        # for p = 3 mod 4, a is a square in 𝔽p² iff its norm is one in 𝔽p
+        return not self or gmpy2.jacobi(self.re**2 + self.im**2, self.gf.p) == 1
 
     def is_square(self):
-        # this can be done much faster, but we're lazy,
-        # so we'll just fake it
         self.gf.counts['issq'] += 1
-        _counts = copy.copy(self.gf.counts)
-        ret = not self or self**((self.gf.p**2 - 1) // 2) == 1
-        self.gf.counts = _counts
-        return ret
-
+        return self._is_square()
 
 ################################################################
 
@@ -220,6 +380,30 @@ class Test:
         assert (a + b) * c == a * c + b * c
         assert a * (b + c) == a * b + a * c
 
+    @staticmethod
+    def test_products():
+        gf = Test.random_field()
+        a, b = gf.random(), gf.random()
+        assert a**5 == a*a*a*a*a
+        for product in (_schoolbook, _karatsuba):
+            re, im = product(a.re, a.im, b.re, b.im)
+            assert gf(re, im) == a * b
+
+    @staticmethod
+    def test_backends():
+        p = Test.random_field().p
+        gf, gg = Field(p, backend='int'), Field(p, backend='gmpy2')
+        assert type(gf.one().re) is int
+        assert type(gg.one().re) is type(gmpy2.mpz(1))
+        a, b = gf.random(), gf.random()
+        c, d = gg(a.re, a.im), gg(b.re, b.im)
+        for x, y in ((a * b, c * d), (a + b, c + d), (a - b, c - d), (~a, ~c), (a**2, c**2), ((a*a).sqrt(), (c*c).sqrt())):
+            assert (x.re, x.im) == (y.re, y.im)
+        with pytest.raises(ZeroDivisionError):
+            ~gg.zero()
+        with pytest.raises(ValueError):
+            Field(p, backend='float')
+
     @staticmethod
     def test_order():
         gf = Test.random_field()
@@ -239,6 +423,32 @@ class Test:
         b = ~a
         assert b * a == a * b == 1
 
+    @staticmethod
+    def test_batch_invert():
+        gf = Test.random_field()
+        assert gf.batch_invert([]) == []
+        elements = [gf.random() for _ in range(9)] + [gf.one(), 5]
+        gf.counts.clear()
+        inverses = gf.batch_invert(elements)
+        assert gf.counts['inv'] == 1
+        assert inverses == [~gf(a) for a in elements]
+
+        with pytest.raises(ZeroDivisionError):
+            gf.batch_invert(elements + [gf.zero()])
+
+    @staticmethod
+    def test_bytes():
+        gf = Test.random_field()
+        assert gf.nbytes == 13
+        a = gf.random()
+        data = a.to_bytes()
+        assert len(data) == 26 and gf.from_bytes(data) == a
+        assert gf.from_bytes(bytearray(b'..' + data), 2) == a
+        with pytest.raises(ValueError):
+            gf.from_bytes(data[:-1])
+        with pytest.raises(ValueError):
+            gf.from_bytes(int(gf.p).to_bytes(13, 'little') * 2)
+
     @staticmethod
     def test_sqrt():
         gf = Test.random_field()
@@ -252,6 +462,16 @@ class Test:
         assert b**2 == a        # correct
         assert a.sqrt() == b    # deterministic
 
+        # the same root as https://ia.cr/2012/685 equation (7), spelled out
+        e1 = (gf.p - 1) // 2
+        e2 = (gf.p + 1) // 4
+        for a in (a, gf(-1), gf(4), gf.random()**2):
+            u = gf.i() if a**e1 == -1 else (1 + a**e1)**e1
+            assert a.sqrt() == u * a**e2
+
+        for e in (0, 1, 2, 31, e1, e2, random.randrange(gf.p**2)):
+            assert gf(*gf._pow((a.re, a.im), e)) == a**e
+
         for _ in range(999):
             a = gf.random()     # square or non-square
             try:
@@ -1,7 +1,37 @@
 
-__all__ = ['TwoIsogeny', 'IsogenyChain']
+__all__ = ['KernelError', 'TwoIsogeny', 'FourIsogeny', 'IsogenyChain', 'chain_codomains']
 
-from curve import Curve, KummerPoint
+import numpy as np
+
+from curve import Curve, KummerPoint, normalize_all, _xDBL
+from strategy import naive_strategy, balanced_strategy, optimal_strategy
+from compiler import Formula
+
+# evaluation of x ↦ x(x·xK - 1) / (x - xK) with s = XK + ZK, d = XK - ZK
+_eval2 = Formula('eval2', ('X', 'Z', 's', 'd'), ('X2', 'Z2'), '''
+    t0 = s * (X - Z)
+    t1 = d * (X + Z)
+    X2 = X * (t0 + t1)
+    Z2 = Z * (t0 - t1)
+''')
+
+# evaluation of the 4-isogeny with k1 = 4ZK², k2 = XK - ZK, k3 = XK + ZK
+_eval4 = Formula('eval4', ('X', 'Z', 'k1', 'k2', 'k3'), ('X4', 'Z4'), '''
+    t0 = X + Z
+    t1 = X - Z
+    X1 = t0 * k2
+    Z1 = t1 * k3
+    t0 = t0 * t1 * k1
+    t1 = (X1 + Z1)**2
+    Z1 = (X1 - Z1)**2
+    X4 = -((t0 + t1) * t1)
+    Z4 = Z1 * (Z1 - t0)
+''')
+
+class KernelError(ValueError):
+    # a kernel point that does not have the order it should have, found
+    # at the step where it happens, so that a chain stops right there
+    pass
 
 class TwoIsogeny:
     def __init__(self, K):
@@ -12,23 +42,37 @@ class TwoIsogeny:
         self._compute()
 
     def _compute(self):
-        self.K._normalize()
-        A = self.K.E.A
-        xK = self.K.x
-        if not self.K or xK * (1 + xK * (A + xK)):
-            raise ValueError('not a point of order 2')
-        if xK:      # when the point is (alpha, 0) for alpha a root of x^2 + Ax + 1
-            # TODO: implement a 2-isogeny here!
-            self.codomain = ???
-
-            ## TODO: make sure you can also push points through
-            self._eval = lambda x,z: self.codomain(???)
-        else:      # when the point is (0,0)  
-            # TODO: implement a 2-isogeny here!
-            self.codomain = ???
-
-            ## TODO: make sure you can also push points through
-            self._eval = lambda x,z: self.codomain(???)
+        # everything is projective, on the domain (A24 : C24) = (A+2C : 4C)
+        E = self.K.E
+        XK, ZK = self.K.x, self.K.z
+        # the Z-coordinate of [2]K, up to a factor 4·ZK
+        if not ZK or XK * (E.C24 * (XK - ZK)**2 + 4 * E.A24 * XK * ZK):
+            raise KernelError('not a point of order 2')
+        if XK:      # when the point is (alpha, 0) for alpha a root of x^2 + Ax + 1
+            # x ↦ x(x·xK - 1) / (x - xK), onto A' = 2(1 - 2xK²)
+            XX, ZZ = XK**2, ZK**2
+            self.codomain = Curve._from_A24(ZZ - XX, ZZ)
+
+            s, d = XK + ZK, XK - ZK
+            def _eval(X, Z):
+                X, Z = _eval2(X.gf, X, Z, s, d)
+                return KummerPoint._new(self.codomain, X, Z)
+            self._eval = _eval
+        else:      # when the point is (0,0)
+            # x ↦ (x-1)² / (2·√(A+2)·x), onto A' = (A+6) / (2·√(A+2))
+            # NB: this costs a square root, which is far more than the
+            # inversion it replaces, and since this map sends the point x = 1
+            # above (0,0) to (0,0) again, a kernel of the form ⟨(1,..)⟩ takes
+            # this branch at every step. Response kernels do not lie above
+            # (0,0), but some challenge kernels do (a few square roots per
+            # chain); we keep this model because the tests (and the slides)
+            # use it.
+            A, C = 4*E.A24 - 2*E.C24, E.C24
+            r = (C * (A + C + C)).sqrt()        # C·√(A+2), up to sign
+            r2 = r + r
+            self.codomain = Curve._from_A24(A + 6*C + r2 + r2, 4 * r2)
+
+            self._eval = lambda X,Z: self.codomain(C * (X - Z)**2, r2 * X * Z)
 
     def __repr__(self):
         return f'{self.domain} —⟶ {self.codomain}'
@@ -36,35 +80,185 @@ class TwoIsogeny:
     def __call__(self, P):
         return self._eval(P.x, P.z)
 
+class FourIsogeny:
+    def __init__(self, K):
+        if not isinstance(K, KummerPoint):
+            raise ValueError('not a point')
+        self.K = K
+        self.domain = K.E
+        self._compute()
+
+    def _compute(self):
+        # the composition of the two 2-isogenies with kernels [2]K and φ(K),
+        # giving exactly the same codomain as two TwoIsogeny steps would
+        E = self.K.E
+        XK, ZK = self.K.x, self.K.z
+        XX, ZZ = XK**2, ZK**2
+        XZ = XK * ZK
+        # [2]K = (α,0) with α = (xK² + 1) / 2xK, as long as [2]K is not (0,0)
+        if not XZ or E.C24 * ((XK - ZK)**2)**2 + 8 * E.A24 * (XX + ZZ) * XZ:
+            # either not of order 4 or above (0,0): do it in two steps
+            # (the TwoIsogeny checks complain if K does not have order 4)
+            phi = TwoIsogeny(E.xDBL(self.K))
+            psi = TwoIsogeny(phi(self.K))
+            self.codomain = psi.codomain
+            self._eval = lambda X,Z: psi(phi._eval(X, Z))
+            return
+
+        # x ↦ -x' for x' the SIKE 4-isogeny, onto A' = 2(1 - 2xK⁴)
+        X4, Z4 = XX**2, ZZ**2
+        self.codomain = Curve._from_A24(Z4 - X4, Z4)
+
+        k1, k2, k3 = 4*ZZ, XK - ZK, XK + ZK
+        def _eval(X, Z):
+            X, Z = _eval4(X.gf, X, Z, k1, k2, k3)
+            return KummerPoint._new(self.codomain, X, Z)
+        self._eval = _eval
+
+    def __repr__(self):
+        return f'{self.domain} —4—⟶ {self.codomain}'
+
+    def __call__(self, P):
+        return self._eval(P.x, P.z)
+
 class IsogenyChain:
-    def __init__(self, K, n):
+    def __init__(self, K, n, strategy=None, radix=2, points=(), retain=False):
+        # points are pushed through every step as it is computed,
+        # and their images end up in .images; every step is dropped as
+        # soon as it has been used, unless retain=True keeps them in
+        # .steps, for evaluating points afterwards
         assert n >= 1
+        if radix not in (2, 4):
+            raise ValueError('radix must be 2 or 4')
 
-        self.steps = IsogenyChain._compute(K, n)
+        self.steps, self.images, self.codomain = IsogenyChain._compute(K, n, strategy, radix, points, retain)
 
         self.domain = K.E
-        self.codomain = self.steps[-1].codomain
+        self.n = n
 
     @staticmethod
-    def _compute(K, n):
-        # TODO: implement a chain of isogenies here!
-        # tip: first implement the naive strategy, only later the balanced one.
-        return ## returns a chain of isogenies in the right format
+    def _strategy(n, strategy, radix):
+        if strategy is None or strategy == 'optimal':
+            return optimal_strategy(n, radix)
+        if strategy == 'balanced':
+            return balanced_strategy(n, radix)
+        if strategy == 'naive':
+            return naive_strategy(n, radix)
+        strategy = list(strategy)
+        if radix == 2 and len(strategy) != n - 1:
+            raise ValueError('strategy does not match the length of the chain')
+        return strategy
+
+    @staticmethod
+    def _compute(K, n, strategy=None, radix=2, points=(), retain=False):
+        # keep a stack of points with their remaining heights: double
+        # the top point as the strategy says, and push everything
+        # through the isogeny once the top point has order 2 (or 4)
+        strategy = iter(IsogenyChain._strategy(n, strategy, radix))
+        steps = [] if retain else None
+        images = list(points)
+        stack = [(K, n)]
+        while stack:
+            P, h = stack[-1]
+            if h > radix // 2:
+                m = next(strategy, None)
+                if m is None or not 1 <= m < h:
+                    raise ValueError('strategy does not match the length of the chain')
+                E = P.E
+                for _ in range(m):
+                    P = E.xDBL(P)
+                stack.append((P, h - m))
+                continue
+            stack.pop()
+            phi = FourIsogeny(P) if h == 2 else TwoIsogeny(P)
+            if retain:
+                steps.append(phi)
+            stack = [(phi(Q), k - h) for Q, k in stack]
+            images = [phi(Q) for Q in images]
+        if next(strategy, None) is not None:
+            raise ValueError('strategy does not match the length of the chain')
+        return steps, images, phi.codomain
 
     def __repr__(self):
-        return f'{self.domain} ——{len(self.steps)}—⟶ {self.codomain}'
+        return f'{self.domain} ——{self.n}—⟶ {self.codomain}'
 
     def __call__(self, P):
+        if self.steps is None:
+            raise ValueError('the steps of this chain were not retained (use retain=True)')
         for step in self.steps:
             P = step(P)
         return P
 
+    def evaluate(self, points, normalize=True):
+        # push several points through the chain, and (by default)
+        # normalize all the images with a single inversion
+        images = [self(P) for P in points]
+        if normalize:
+            normalize_all(images)
+        return images
+
+################################################################
+
+# The same chains for N kernels at once, on FieldVectors: the curves are
+# pairs of vectors (A24, C24), the points pairs (X, Z). There is nothing to
+# branch on, so lanes for which the classes above would take another path
+# (a kernel above (0,0)) or fail are flagged in a mask of bad lanes, and
+# have to be redone one by one; the other lanes count exactly the same
+# operations as IsogenyChain does.
+
+def _two_isogeny_vector(A24, C24, XK, ZK):
+    bad = ZK.iszero() | ~(XK * (C24 * (XK - ZK)**2 + 4 * A24 * XK * ZK)).iszero()
+    bad |= XK.iszero()
+    XX, ZZ = XK**2, ZK**2
+    A24, C24 = ZZ - XX, ZZ
+    s, d = XK + ZK, XK - ZK
+    return A24, C24, bad, lambda X,Z: _eval2.vector(X.gf, X, Z, s, d)
+
+def _four_isogeny_vector(A24, C24, XK, ZK):
+    XX, ZZ = XK**2, ZK**2
+    XZ = XK * ZK
+    bad = XZ.iszero() | ~(C24 * ((XK - ZK)**2)**2 + 8 * A24 * (XX + ZZ) * XZ).iszero()
+    X4, Z4 = XX**2, ZZ**2
+    A24, C24 = Z4 - X4, Z4
+    k1, k2, k3 = 4*ZZ, XK - ZK, XK + ZK
+    return A24, C24, bad, lambda X,Z: _eval4.vector(X.gf, X, Z, k1, k2, k3)
+
+def chain_codomains(A24, C24, XK, ZK, n, strategy=None, radix=2):
+    # IsogenyChain(K, n, strategy, radix).codomain for every lane,
+    # returns the codomains (A24, C24) and the mask of bad lanes
+    gf = A24.gf
+    strategy = iter(IsogenyChain._strategy(n, strategy, radix))
+    bad = np.zeros(len(A24), dtype=bool)
+    stack = [(XK, ZK, n)]
+    while stack:
+        X, Z, h = stack[-1]
+        if h > radix // 2:
+            m = next(strategy, None)
+            if m is None or not 1 <= m < h:
+                raise ValueError('strategy does not match the length of the chain')
+            for _ in range(m):
+                X, Z = _xDBL.vector(gf, X, Z, A24, C24)
+            bad |= X.iszero() & Z.iszero()
+            stack.append((X, Z, h - m))
+            continue
+        stack.pop()
+        step = _four_isogeny_vector if h == 2 else _two_isogeny_vector
+        A24, C24, failed, phi = step(A24, C24, X, Z)
+        bad |= failed | C24.iszero() | A24.iszero() | (A24 == C24)
+        stack = [(*phi(X, Z), k - h) for X, Z, k in stack]
+        for X, Z, _ in stack:
+            bad |= X.iszero() & Z.iszero()
+    if next(strategy, None) is not None:
+        raise ValueError('strategy does not match the length of the chain')
+    return A24, C24, bad
+
 ################################################################
 
 import pytest
 import random
 
 from field import Field
+from vector import FieldVector
 
 class Test:
     @staticmethod
@@ -101,8 +295,68 @@ class Test:
         E = Curve(gf(0))
         K = E(23, 1)
         assert 2**28 * K and not 2**29*K
-        phi = IsogenyChain(K, 29)
+        with pytest.raises(KernelError):
+            IsogenyChain(K, 30)
+        with pytest.raises(KernelError):
+            IsogenyChain(K, 28, radix=4)
+        phi = IsogenyChain(K, 29, retain=True)
         assert len(phi.steps) == 29
+        assert not gf.counts['inv']     # the chain is inversion-free
         assert not phi(K)
         assert phi(E(7, 1)) == phi.codomain(920069272, 1)
 
+        points = [E(7, 1), K, E(gf(1, 2))]
+        images = phi.evaluate(points)
+        assert images == [phi(P) for P in points]
+        assert IsogenyChain(K, 29, points=points).images == images
+        assert all(P.z == 1 or P == phi.codomain(1, 0) for P in images)
+
+        psi = IsogenyChain(K, 29)
+        assert psi.steps is None and psi.codomain == phi.codomain
+        with pytest.raises(ValueError):
+            psi(K)
+
+    @staticmethod
+    def test_isogenychain_radix4():
+        gf = Field(2**31 - 1)
+        E = Curve(gf(0))
+        P = E(7, 1)
+        # the first kernel is (0,0) resp. (i,0), both for odd and even n
+        for K, n in ((E(23, 1), 29), (2 * E(23, 1), 28), (E(gf(1, 2)), 31), (2 * E(gf(1, 2)), 30)):
+            assert 2**(n-1) * K and not 2**n * K
+            phi = IsogenyChain(K, n, retain=True)
+            for strategy in ('naive', 'balanced', 'optimal'):
+                psi = IsogenyChain(K, n, strategy=strategy, radix=4, retain=True)
+                assert len(psi.steps) == (n + 1) // 2
+                assert psi.codomain == phi.codomain
+                assert psi(P) == phi(P)
+                assert not psi(K)
+
+    @staticmethod
+    def test_chain_codomains():
+        gf = Field(2**31 - 1)
+        E = Curve(gf(0))
+        F = TwoIsogeny(E(0, 1)).codomain
+        n = 29
+        kernels = []
+        for k in range(1, 30):
+            for G in (E, F):
+                if G.is_x_coordinate(gf(1, k)):
+                    K = 4 * G(gf(1, k))
+                    T = 2**(n-1) * K
+                    if T and T.x:       # of order 2^n, not above (0,0)
+                        kernels.append(K)
+        # and two lanes that go wrong: above (0,0), and of too small order
+        kernels += [E(23, 1), 2 * E(23, 1)]
+        for radix in (2, 4):
+            gf.counts.clear()
+            codomains = [IsogenyChain(K, n, radix=radix).codomain for K in kernels[:-2]]
+            counts = dict(gf.counts)
+            gf.counts.clear()
+            A24, C24, bad = chain_codomains(FieldVector(gf, [K.E.A24 for K in kernels]),
+                                            FieldVector(gf, [K.E.C24 for K in kernels]),
+                                            FieldVector(gf, [K.x for K in kernels]),
+                                            FieldVector(gf, [K.z for K in kernels]), n, radix=radix)
+            assert {k: c * len(kernels) for k,c in counts.items()} == {k: c * len(codomains) for k,c in gf.counts.items()}
+            assert bad.tolist() == [False] * len(codomains) + [True] * 2
+            assert [Curve._from_A24(a, c) for a,c in zip(A24[:-2], C24[:-2])] == codomains
@@ -4,32 +4,24 @@ def three_point_ladder(P, Q, PmQ, s):
     assert Q.z == 1
     assert PmQ.z == 1
 
-    binary = lambda n: n>0 and [n&1]+binary(n>>1) or []
-    bits = binary(s)
-
     P0 = Q
     P1 = P
     P2 = PmQ
     E = P.E
 
-    for i in range(len(bits)):
-        if bits[i] == 1:
-            # this can be done by one function xDBLADD
-            # to be faster and more elegant
-            P1 = E.xADD(P0, P1, P2)
-            P0 = E.xDBL(P0)
-            # P0, P1 = xDBLADD(P0, P1, P2)
+    for i in range(s.bit_length()):
+        if s >> i & 1:
+            P0, P1 = E.xDBLADD(P0, P1, P2)
         else:
-            P2 = E.xADD(P0, P2, P1)
-            P0 = E.xDBL(P0)
-            # P0, P2 = xDBLADD(P0, P2, P1)
+            P0, P2 = E.xDBLADD(P0, P2, P1)
 
     return P1
 
 
 import random
 from field import Field
-from curve import Curve
+from curve import Curve, normalize_all
+from compiler import Formula
 
 def test_three_point_ladder():
     from sqisign import p, f
@@ -50,6 +42,23 @@ def test_three_point_ladder():
     assert 2**(f-1) * R
 
 
+_point_difference = Formula('point_difference', ('xP', 'xQ', 'A'), ('t0', 't1', 'PmQZ'), '''
+    PmQZ = xP - xQ
+    t2 = xP * xQ
+    t3 = t2 - 1
+    t0 = PmQZ * t3
+    PmQZ = PmQZ**2
+    t0 = t0**2
+    t1 = t2 + 1
+    t3 = xP + xQ
+    t1 = t1 * t3
+    t2 = t2 * A
+    t2 = t2 + t2
+    t1 = t1 + t2
+    t2 = t1**2
+    t0 = t2 - t0
+''')
+
 def point_difference(xP, xQ):
     #we assume xP, xQ and A are affine
     assert xP.z == 1
@@ -61,23 +70,9 @@ def point_difference(xP, xQ):
     A = E.A
     F = E.A.gf
 
-    PmQZ = xP.x - xQ.x
-    t2 = xP.x * xQ.x
-    t3 = t2 - F.one()
-    t0 = PmQZ * t3
-    PmQZ = PmQZ**2
-    t0 = t0**2
-    t1 = t2 + F.one()
-    t3 = xP.x + xQ.x
-    t1 = t1 * t3
-    t2 = t2 * A
-    t2 = t2 + t2
-    t1 = t1 + t2
-    t2 = t1**2
-    t0 = t2 - t0
+    t0, t1, PmQZ = _point_difference(F, xP.x, xQ.x, A)
 
-    assert t0.is_square()
-    t0 = t0.sqrt()
+    t0 = t0.sqrt()      # raises if t0 is not a square
     PmQX = t0 + t1
 
     PmQ = PmQX / PmQZ
@@ -98,16 +93,25 @@ def test_point_difference():
     assert T in ((a-b)*P, (a+b)*P)
 
 
-def get_kernel_point(xP, xQ, s):
-    # should get diff of xP and xQ
+def get_kernel_point(xP, xQ, s, xPmQ=None):
+    # should get diff of xP and xQ, unless it is given (affine)
     # then performs three point ladder
     # returns K = xP + s*xQ
 
-    xP._normalize()
-    xQ._normalize()
-    PmQ = point_difference(xP, xQ)
-    K = three_point_ladder(xP, xQ, PmQ, s)
+    normalize_all((xP, xQ))
+    if xPmQ is None:
+        xPmQ = point_difference(xP, xQ)
+    K = three_point_ladder(xP, xQ, xPmQ, s)
 
     return K
 
-
+def test_get_kernel_point():
+    from sqisign import p, deterministic_basis_two_torsion
+    gf = Field(p)
+    E = Curve(gf(6))
+    P, Q, PmQ = deterministic_basis_two_torsion(E, difference=True)
+    s = random.randrange(2**99)
+    gf.counts.clear()
+    K = get_kernel_point(P, Q, s, PmQ)
+    assert not gf.counts['sqrt']
+    assert K == get_kernel_point(P, Q, s)
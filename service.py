@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+__all__ = ['VerificationService', 'connect', 'request', 'load']
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
+import sys
+import time
+
+from field import Field
+from sqisign import p, msg, record_to_bytes, _worker_init, _worker_check_records
+
+# An asyncio front end to verification, over a Unix or TCP socket:
+#     python3 service.py serve --unix /tmp/sqisign.sock
+#     python3 service.py load --unix /tmp/sqisign.sock --requests 200
+# Requests and responses are frames, a 4-byte little-endian length and
+# that many bytes. A request is a record in the wire format of
+# sqisign.iter_records, and its response the JSON {"valid", "reason"} of
+# sqisign.check_signature; the responses on a connection come in the order
+# of its requests. An empty request asks for the metrics of the service.
+#
+# Requests wait in a bounded queue, from which they are taken in micro-
+# batches: a batch is sent to the worker pool once it holds max_batch
+# requests or its first request has waited window seconds, and at most
+# one batch per worker is in flight, so that batches grow under load. A
+# full queue stops the service from reading more requests, which pushes
+# back on the clients through the socket, and so does a connection with
+# max_inflight unanswered requests.
+
+_header = 4
+_max_frame = 1 << 20
+
+async def _read_frame(reader):
+    # the payload of the next frame, or None at the end of the stream
+    try:
+        size = int.from_bytes(await reader.readexactly(_header), 'little')
+        if size > _max_frame:
+            raise ValueError('frame too large')
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ValueError('truncated frame')
+        return None
+
+def _frame(payload):
+    return len(payload).to_bytes(_header, 'little') + payload
+
+def _percentiles(values, ps=(50, 90, 99)):
+    # nearest-rank percentiles, in milliseconds
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f'p{q}': 1000 * values[min(len(values) - 1, len(values) * q // 100)] for q in ps}
+
+class VerificationService:
+    def __init__(self, gf, workers=1, window=.005, max_batch=32, max_pending=256, max_inflight=64):
+        self.gf = gf
+        self.workers = workers
+        self.window = window
+        self.max_batch = max_batch
+        self.max_inflight = max_inflight
+        self.counts = collections.defaultdict(int)
+        self.latencies = collections.deque(maxlen=10000)      # seconds, of the last requests
+        self._queue = asyncio.Queue(max_pending)
+        self._full = asyncio.Event()
+        self._slots = asyncio.Semaphore(workers)
+        self._pool = None
+        self._server = None
+        self._tasks = set()
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        # listens on the Unix socket path, or else on host:port
+        self._pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_worker_init,
+                                                            initargs=(int(self.gf.p), self.gf.backend))
+        # start the workers now: forked later, they would inherit the sockets
+        # of the connections open at the time, and keep them from closing
+        await asyncio.get_running_loop().run_in_executor(self._pool, _worker_check_records, [])
+        self._spawn(self._batcher())
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._connection, path)
+        else:
+            self._server = await asyncio.start_server(self._connection, host, port)
+        return self._server
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for task in list(self._tasks):
+            task.cancel()
+        # shutting the pool down waits for the workers, so not in the loop
+        await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self._pool.shutdown, cancel_futures=True))
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def metrics(self):
+        batches = self.counts['batches']
+        return {**self.counts,
+                'pending': self._queue.qsize(),
+                'mean batch': self.counts['requests'] / batches if batches else 0,
+                **_percentiles(self.latencies)}
+
+    ################################################################
+
+    async def _connection(self, reader, writer):
+        responses = asyncio.Queue(self.max_inflight)
+        sender = self._spawn(self._send(responses, writer))
+        try:
+            while (payload := await _read_frame(reader)) is not None:
+                if not payload:
+                    await responses.put(self.metrics())
+                    continue
+                future = asyncio.get_running_loop().create_future()
+                await responses.put(future)
+                await self._queue.put((payload, future, time.perf_counter()))
+                if self._queue.qsize() + 1 >= self.max_batch:
+                    self._full.set()
+        except (ValueError, ConnectionError):
+            self.counts['bad connections'] += 1
+        finally:
+            await responses.put(None)
+            await sender
+
+    async def _send(self, responses, writer):
+        # writes the responses in order, up to the None that ends them; once
+        # the client has gone, it still takes them, so that the handler never
+        # waits for room in the queue forever
+        try:
+            while (response := await responses.get()) is not None:
+                if isinstance(response, asyncio.Future):
+                    try:
+                        valid, reason = await response
+                        response = {'valid': valid, 'reason': reason}
+                    except Exception as e:
+                        response = {'error': str(e)}
+                writer.write(_frame(json.dumps(response).encode()))
+                await writer.drain()
+        except ConnectionError:
+            while await responses.get() is not None:
+                pass
+        finally:
+            writer.close()
+
+    async def _batcher(self):
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            if self._queue.qsize() + 1 < self.max_batch:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._spawn(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        self.counts['batches'] += 1
+        self.counts['requests'] += len(batch)
+        try:
+            results = await loop.run_in_executor(self._pool, _worker_check_records, [payload for payload,_,_ in batch])
+        except Exception as e:
+            self.counts['errors'] += len(batch)
+            for _, future, _ in batch:
+                future.set_exception(e)
+        else:
+            now = time.perf_counter()
+            for (_, future, start), result in zip(batch, results):
+                self.counts['valid' if result[0] else 'invalid'] += 1
+                self.latencies.append(now - start)
+                future.set_result(result)
+        finally:
+            self._slots.release()
+
+################################################################
+
+# the client side: a connection, requests on it, and a load generator that
+# replays the signatures of good_signatures.py from several connections
+
+async def connect(path=None, host='127.0.0.1', port=None):
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+async def request(reader, writer, payload):
+    # sends a record (or b'' for the metrics), and returns the response
+    writer.write(_frame(payload))
+    await writer.drain()
+    response = await _read_frame(reader)
+    if response is None:
+        raise ConnectionError('connection closed by the service')
+    return json.loads(response)
+
+async def load(records, requests, connections=8, **address):
+    # sends requests records, cycling through them, from several
+    # connections at once, one request in flight on each; returns
+    # the responses in order, the latencies and the elapsed time
+    responses = [None] * requests
+    latencies = []
+    indices = iter(range(requests))
+
+    async def client():
+        reader, writer = await connect(**address)
+        try:
+            for j in indices:
+                start = time.perf_counter()
+                responses[j] = await request(reader, writer, records[j % len(records)])
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return responses, latencies, time.perf_counter() - start
+
+def _records(gf, mode='any'):
+    from good_signatures import get_signatures
+    records = []
+    for pk, sig, compressed in get_signatures(gf.i()):
+        if mode != 'compressed':
+            records.append(record_to_bytes(pk, sig, msg))
+        if mode != 'uncompressed':
+            records.append(record_to_bytes(pk, compressed, msg))
+    return records
+
+async def _serve(args):
+    service = VerificationService(Field(p, args.backend), args.workers, args.window,
+                                  args.max_batch, args.max_pending, args.max_inflight)
+    server = await service.start(args.unix, args.host, args.port)
+    print(f'listening on {", ".join(str(s.getsockname()) for s in server.sockets)}', file=sys.stderr)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.close()
+
+async def _load(args):
+    address = {'path': args.unix} if args.unix else {'host': args.host, 'port': args.port}
+    records = _records(Field(p), args.mode)
+    responses, latencies, seconds = await load(records, args.requests, args.connections, **address)
+    invalid = sum(not r.get('valid') for r in responses)
+    print(f'{args.requests} requests ({invalid} invalid) in {seconds:.2f}s, {args.requests / seconds:.2f}/s')
+    print(f'client latency (ms): {json.dumps(_percentiles(latencies))}')
+    reader, writer = await connect(**address)
+    print(f'service metrics: {json.dumps(await request(reader, writer, b""))}')
+    writer.close()
+    return int(bool(invalid))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='service.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='run the verification service')
+    serve.add_argument('--workers', type=int, default=1, help='worker processes')
+    serve.add_argument('--window', type=float, default=.005, help='seconds a batch waits for more requests')
+    serve.add_argument('--max-batch', type=int, default=32)
+    serve.add_argument('--max-pending', type=int, default=256, help='bound of the queue of requests')
+    serve.add_argument('--max-inflight', type=int, default=64, help='unanswered requests per connection')
+    serve.add_argument('--backend', choices=sorted(Field.backends), default='gmpy2')
+    client = commands.add_parser('load', help='replay good_signatures.py against the service')
+    client.add_argument('--requests', type=int, default=100)
+    client.add_argument('--connections', type=int, default=8)
+    client.add_argument('--mode', choices=('any', 'uncompressed', 'compressed'), default='any')
+    for command in (serve, client):
+        command.add_argument('--unix', help='the path of a Unix socket')
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8437)
+    args = parser.parse_args(args)
+    try:
+        return asyncio.run(_serve(args) if args.command == 'serve' else _load(args))
+    except KeyboardInterrupt:
+        return 0
+
+################################################################
+
+import pytest
+
+class Test:
+    @staticmethod
+    def test_service(tmp_path):
+        gf = Field(p)
+        records = _records(gf)[:4]
+        from good_signatures import get_signatures
+        pk, sig, _ = get_signatures(gf.i())[0]
+        records.append(record_to_bytes(pk, sig, b'Goodbye, world!'))
+        records.append(b'garbage')
+        path = str(tmp_path / 'service.sock')
+
+        async def run():
+            service = VerificationService(gf, workers=1, window=.05, max_batch=4)
+            await service.start(path)
+            try:
+                responses, latencies, _ = await load(records, 12, connections=3, path=path)
+                reader, writer = await connect(path)
+                metrics = await request(reader, writer, b'')
+                writer.close()
+            finally:
+                await service.close()
+            return responses, latencies, metrics
+
+        responses, latencies, metrics = asyncio.run(run())
+        expected = [{'valid': True, 'reason': None}] * 4 + [{'valid': False, 'reason': 'mismatch'},
+                                                            {'valid': False, 'reason': 'decode'}]
+        assert responses == expected * 2
+        assert len(latencies) == 12
+        assert metrics['requests'] == 12 and metrics['valid'] == 8
+        assert metrics['batches'] < 12          # requests were batched
+        assert 0 < metrics['p50'] <= metrics['p99']
+
+    @staticmethod
+    def test_disconnect(tmp_path):
+        # a client that sends more than max_inflight requests and leaves
+        # without reading the responses leaves nothing behind
+        path = str(tmp_path / 'service.sock')
+
+        async def run():
+            service = VerificationService(Field(p), workers=1, window=.01, max_batch=2, max_inflight=2)
+            await service.start(path)
+            tasks = len(asyncio.all_tasks())
+            try:
+                reader, writer = await connect(path)
+                writer.write(_frame(b'garbage') * 20)
+                await writer.drain()
+                writer.close()
+                for _ in range(100):
+                    await asyncio.sleep(.05)
+                    if len(asyncio.all_tasks()) == tasks:
+                        break
+                return len(asyncio.all_tasks()) - tasks
+            finally:
+                await service.close()
+
+        assert asyncio.run(run()) == 0
+
+if __name__ == '__main__':
+    sys.exit(main())
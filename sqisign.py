@@ -1,22 +1,77 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import concurrent.futures
+import json
+import queue
 import random
-from field import Field
-from curve import Curve
-from isogeny import IsogenyChain
+import sys
+import threading
+import time
+import types
+from field import Field, FieldElement
+from curve import Curve, normalize_all
+from isogeny import IsogenyChain, KernelError, chain_codomains
+from vector import FieldVector
+from store import CurveStore, DecompressionStore
 
 f = 1 << 7
 cof = 0xb34281e63cfdf2985b9f1f5de85f0f51
 p = (cof << f) - 1
+nblocks = 8         # blocks of 2^f-isogenies in a response
 
 ################################################################
 
-def deterministic_basis_two_torsion(E):
-    F = E.A.gf
-
-    # TODO: this one is tricky. good luck :^)
-
-    return xP, xQ
+# the bases (and their differences) on the public-key curves seen so far
+basis_store = CurveStore()
+
+def _two_torsion_candidates(E):
+    # the points P of order 2^f above x = 1 + k·i, k = 0, 1, ...,
+    # together with T = 2^(f-1)·P
+    F = E.gf
+    k = 0
+    while True:
+        x = F(1, k)
+        k += 1
+        if not E.is_x_coordinate(x):
+            continue
+        P = cof * E(x)
+        T = P.double_k(f-1)
+        if T:
+            yield P, T
+
+def complement_two_torsion(E, R, TR=None):
+    # the first point of the same walk that, together with
+    # the point R of order 2^f (and TR = 2^(f-1)·R), is a basis of E[2^f]
+    if TR is None:
+        TR = R.double_k(f-1)
+    for xS, TS in _two_torsion_candidates(E):
+        if TS != TR:
+            return xS
+
+def deterministic_basis_two_torsion(E, store=None, difference=False):
+    # with difference=True, returns x(P-Q) as well, for get_kernel_point:
+    # that costs a square root, unless a store already holds it
+    if store is not None:
+        entry = store.get(E)
+        if entry is not None and 'PmQ' in entry:
+            P, Q = E(entry['P']), E(entry['Q'])
+            return (P, Q, E(entry['PmQ'])) if difference else (P, Q)
+
+    # walk through x = 1 + k·i until we find two points of order 2^f
+    # that do not lie above the same point of order 2
+    points = _two_torsion_candidates(E)
+    xP, TP = next(points)
+    for xQ, TQ in points:
+        if TQ != TP:
+            normalize_all((xP, xQ))
+            if not (difference or store is not None):
+                return xP, xQ
+            PmQ = point_difference(xP, xQ)
+            if store is not None:
+                store.put(E, P=xP.x, Q=xQ.x, PmQ=PmQ.x)
+            return (xP, xQ, PmQ) if difference else (xP, xQ)
 
 def test_deterministic_basis_two_torsion():
     gf = Field(p)
@@ -29,8 +84,33 @@ def test_deterministic_basis_two_torsion():
     assert 2**(f-1) * Q
     assert 2**(f-1) * P != 2**(f-1) * Q
 
+def test_pushed_basis():
+    gf = Field(p)
+    E = Curve(gf(6))
+    blocks = [(random.randrange(2), random.randrange(2**f)) for _ in range(3)]
+    # the chains check that every kernel has order 2^f
+    E2 = compute_compressed_response(E, blocks, store=None, pushed=True)
+    assert compute_compressed_response(E, blocks, store=None, pushed=True) == E2
+    assert compute_compressed_response(E, blocks[:1], store=None, pushed=True) == \
+           compute_compressed_response(E, blocks[:1], store=None)
+
+def test_basis_store():
+    from good_signatures import get_signatures
+    gf = Field(p)
+    pk, _, compressed = get_signatures(gf.i())[0]
+    store = CurveStore()
+    E2 = compute_compressed_response(Curve(pk), compressed[0], store)
+    assert len(store) == 1
+    cost = gf.cost()
+    gf.counts.clear()
+    store.counts.clear()
+    assert compute_compressed_response(Curve(pk), compressed[0], store) == E2
+    assert dict(store.counts) == {'hits': 1}
+    assert gf.counts['sqrt'] == len(compressed[0]) - 1      # none for the first block
+    assert gf.cost() < cost
 
-from magic import three_point_ladder, get_kernel_point
+
+from magic import three_point_ladder, get_kernel_point, point_difference
 
 
 from hashlib import sha256
@@ -41,34 +121,56 @@ def hash_to_integer(message):
 
 def hash_message(E, message):
 
-    xP, xQ = deterministic_basis_two_torsion(E)
+    xP, xQ, xPmQ = deterministic_basis_two_torsion(E, difference=True)
     s = hash_to_integer(message)
 
-    return get_kernel_point(xP, xQ, s)
+    return get_kernel_point(xP, xQ, s, xPmQ)
 
 
 def compute_uncompressed_response(E, blocks):
     for xK in blocks:
         K = E(xK)
-        phi = IsogenyChain(K, f)
+        phi = IsogenyChain(K, f, radix=4)
         E = phi.codomain
     
     return E
 
-def compute_compressed_response(E, blocks):
+def compute_compressed_response(E, blocks, store=None, pushed=False):
+    for _, E in _compressed_kernels(E, blocks, store, pushed):
+        pass
+    return E
+
+def _compressed_kernels(E, blocks, store=None, pushed=False):
+    # yields the kernel of every block and the codomain of its chain
+    # with pushed=True, the basis of every block after the first is
+    # (S, φ(Q)) for Q the second basis point of the previous block, and S
+    # from complement_two_torsion(): the image of the 2^f-torsion is only
+    # the cyclic kernel of the dual, so S still has to be found, but the
+    # kernel S + s·φ(Q) never backtracks, and swap is ignored. This is a
+    # different encoding, for signatures that were made the same way.
+    # Pushing 2^(f-1)·Q along as well saves the doublings to find it.
+    R = None
     for swap,s in blocks:
-        P, Q = deterministic_basis_two_torsion(E)
-        if swap:
-            P,Q = Q,P
-        K = get_kernel_point(P, Q, s)
-        phi = IsogenyChain(K, f)
+        if R is None:
+            P, Q, PmQ = deterministic_basis_two_torsion(E, store, difference=True)
+            if swap:
+                P,Q = Q,P       # x(Q-P) = x(P-Q)
+            if pushed:
+                TQ = Q.double_k(f-1)
+        else:
+            P, Q, TQ = complement_two_torsion(E, R, TR), R, TR
+            PmQ = None
+        K = get_kernel_point(P, Q, s, PmQ)
+        phi = IsogenyChain(K, f, radix=4, points=[Q, TQ] if pushed else ())
         E = phi.codomain
-    
-    return E
+        if pushed:
+            R, TR = phi.images
+        store = None        # only the public-key curve comes back
+        yield K, E
 
 def recompute_challenge(curve, message):
      K = hash_message(curve, message)
-     return IsogenyChain(K, 128).codomain
+     return IsogenyChain(K, 128, radix=4).codomain
 
 def verify_uncompressed_signature(pk, signature, message):
     EA = Curve(pk)
@@ -89,19 +191,749 @@ def verify_compressed_signature(pk, signature, message):
     blocks = signature[0]
     E1 = Curve(signature[1])
 
-    E2_resp = compute_compressed_response(EA, blocks)
+    E2_resp = compute_compressed_response(EA, blocks, basis_store)
     E2_chall = recompute_challenge(E1, message)
 
     return E2_resp == E2_chall
 
 ################################################################
 
+# Decompression: the kernels that a compressed signature encodes, as the
+# affine x-coordinates that an uncompressed signature consists of. Both
+# verifications then compute the very same chains, so they always agree,
+# and once a signature has been decompressed it can be verified without
+# any basis search, square root or three-point ladder.
+
+def _decompress(pk, compressed):
+    # the uncompressed signature, and the response curve on the way
+    blocks, E1 = compressed
+    kernels = []
+    for K, E in _compressed_kernels(Curve(pk), blocks, basis_store):
+        kernels.append(K)
+    normalize_all(kernels)
+    return ([K.x for K in kernels], E1), E
+
+def decompress_signature(pk, compressed):
+    return _decompress(pk, compressed)[0]
+
+def _worker_decompress(encoded):
+    # None for a signature on which decompression fails with an error
+    compressed, *item = encoded
+    try:
+        pk, signature, _ = _decode(_worker_field, compressed, *item)
+        blocks, E1 = decompress_signature(pk, signature)
+    except (ValueError, ArithmeticError):
+        return None
+    return [(int(xK.re), int(xK.im)) for xK in blocks]
+
+def decompress_batch(items, workers=None, chunksize=1):
+    # decompress_signature for a list of (pk, compressed) on a process pool,
+    # with None for those that cannot be decompressed
+    items = list(items)
+    if not items:
+        return []
+    gf = items[0][0].gf
+    encoded = [_encode((pk, compressed, b'')) for pk,compressed in items]
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_worker_init,
+                                                initargs=(int(gf.p), gf.backend)) as pool:
+        blocks = list(pool.map(_worker_decompress, encoded, chunksize=chunksize))
+    return [None if b is None else ([gf(*xK) for xK in b], compressed[1])
+            for b,(_,compressed) in zip(blocks, items)]
+
+def verify_decompressing(pk, compressed, message, store):
+    # verify_compressed_signature, which keeps the uncompressed form in a
+    # DecompressionStore, and verifies the uncompressed form from then on
+    signature = store.get(pk, compressed)
+    if signature is not None:
+        return verify_uncompressed_signature(pk, signature, message)
+    E1 = Curve(compressed[1])
+    signature, E2_resp = _decompress(pk, compressed)
+    store.put(pk, compressed, signature)
+    return E2_resp == recompute_challenge(E1, message)
+
+def test_decompress_signature():
+    from good_signatures import get_signatures
+    gf = Field(p)
+    sigs = get_signatures(gf.i())[:2]
+    decompressed = [decompress_signature(pk, compressed) for pk,_,compressed in sigs]
+    for (pk, sig, _), signature in zip(sigs, decompressed):
+        # other generators of the same kernels than the signer's
+        assert compute_uncompressed_response(Curve(pk), signature[0]) == compute_uncompressed_response(Curve(pk), sig[0])
+        assert verify_uncompressed_signature(pk, signature, msg)
+    items = [(pk, compressed) for pk,_,compressed in sigs]
+    items.insert(1, (gf(0, 1), sigs[0][2]))        # on another curve, the kernels are wrong
+    assert decompress_batch(items, workers=1) == [decompressed[0], None, decompressed[1]]
+
+    pk, sig, compressed = sigs[0]
+    store = DecompressionStore()
+    for message in (msg, b'Goodbye, world!'):
+        gf.counts.clear()
+        verdict = verify_compressed_signature(pk, compressed, message)
+        cost = gf.cost()
+        gf.counts.clear()
+        assert verify_decompressing(pk, compressed, message, store) == verdict
+        assert gf.cost() < cost + 2 * Field.weights['inv']
+        gf.counts.clear()
+        assert verify_decompressing(pk, compressed, message, store) == verdict
+        assert gf.cost() < cost / 2
+    assert dict(store.counts) == {'misses': 1, 'hits': 3}
+
+################################################################
+
+# The wire format, little-endian, and of fixed width for given p, f and
+# nblocks (except for the messages in records):
+#     element     re, im                                  2·gf.nbytes
+#     signature   b'U', nblocks elements xK, E1
+#              or b'C', nblocks times swap (1), s (f/8), E1
+#     record      pk, signature, message length (4), message
+# Decoding reads straight from a memoryview of the data (bytes, an mmap of
+# a file, ...), and counts no field operations.
+
+def signature_to_bytes(signature):
+    # raises ValueError for what signature_from_bytes could not read back
+    blocks, E1 = signature
+    if len(blocks) != nblocks:
+        raise ValueError(f'a signature has {nblocks} blocks')
+    if all(isinstance(xK, FieldElement) for xK in blocks):
+        data = b'U' + b''.join(xK.to_bytes() for xK in blocks)
+    else:
+        if not all(swap in (0, 1) and 0 <= s < 2**f for swap,s in blocks):
+            raise ValueError('compressed block out of range')
+        data = b'C' + b''.join(bytes([swap]) + int(s).to_bytes(f // 8, 'little') for swap,s in blocks)
+    return data + E1.to_bytes()
+
+def signature_from_bytes(gf, data, offset=0):
+    # returns the signature and the offset right after it
+    data = memoryview(data)
+    n = 2 * gf.nbytes
+    kind = bytes(data[offset:offset+1])
+    offset += 1
+    if kind == b'U':
+        blocks = [gf.from_bytes(data, offset + k*n) for k in range(nblocks)]
+        offset += nblocks * n
+    elif kind == b'C':
+        blocks = []
+        for _ in range(nblocks):
+            swap = data[offset]
+            if swap > 1:
+                raise ValueError('swap is not a bit')
+            blocks.append((bool(swap), int.from_bytes(data[offset+1:offset+1+f//8], 'little')))
+            offset += 1 + f // 8
+    else:
+        raise ValueError('unknown kind of signature')
+    return (blocks, gf.from_bytes(data, offset)), offset + n
+
+def record_to_bytes(pk, signature, message):
+    return pk.to_bytes() + signature_to_bytes(signature) + len(message).to_bytes(4, 'little') + message
+
+def _record_size(gf, data, offset=0):
+    # the size of the record at data[offset:], or None if data
+    # does not reach far enough to tell
+    n = 2 * gf.nbytes
+    if len(data) < offset + n + 1:
+        return None
+    block = {ord('U'): n, ord('C'): 1 + f // 8}.get(data[offset+n])
+    if block is None:
+        raise ValueError('unknown kind of signature')
+    header = n + 1 + nblocks * block + n
+    if len(data) < offset + header + 4:
+        return None
+    return header + 4 + int.from_bytes(data[offset+header:offset+header+4], 'little')
+
+def iter_records(gf, data):
+    # yields (pk, signature, message) for every record in data; the
+    # messages are memoryviews into data
+    data = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        size = _record_size(gf, data, offset)
+        if size is None or len(data) < offset + size:
+            raise ValueError('truncated record')
+        pk = gf.from_bytes(data, offset)
+        signature, end = signature_from_bytes(gf, data, offset + 2 * gf.nbytes)
+        yield pk, signature, data[end+4:offset+size]
+        offset += size
+
+def test_wire_format(tmp_path):
+    import mmap
+    from good_signatures import get_signatures
+    gf = Field(p)
+    pk, sig, compressed = get_signatures(gf.i())[0]
+    assert len(signature_to_bytes(sig)) == 1 + 9 * 2 * gf.nbytes
+    assert len(signature_to_bytes(compressed)) == 1 + nblocks * (1 + f // 8) + 2 * gf.nbytes
+    path = tmp_path / 'signatures.bin'
+    path.write_bytes(record_to_bytes(pk, sig, msg) + record_to_bytes(pk, compressed, b''))
+    gf.counts.clear()
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        records = [(pk, signature, bytes(message)) for pk, signature, message in iter_records(gf, data)]
+    assert not gf.counts
+    assert records == [(pk, sig, msg), (pk, compressed, b'')]
+    assert verify_uncompressed_signature(*records[0])
+    with pytest.raises(ValueError):
+        list(iter_records(gf, path.read_bytes()[:-1]))
+    blocks, E1 = compressed
+    for bad in ((sig[0][:-1], sig[1]), (blocks[:-1], E1),
+                (blocks[:-1] + [(False, 2**f)], E1), (blocks[:-1] + [(False, -1)], E1)):
+        with pytest.raises(ValueError):
+            signature_to_bytes(bad)
+
+################################################################
+
+# Cheap checks in front of verification, so that malformed signatures
+# are rejected before any isogeny is computed, and a reason code for
+# every rejection:
+#     'field'     a field element that is not a reduced element of 𝔽p²
+#     'singular'  the public key or E1 is not an elliptic curve
+#     'blocks'    the wrong number of blocks
+#     'swap', 's' a compressed block out of range
+#     'kernel'    a kernel of the wrong order, found at the step it fails
+#     'invalid'   any other error during verification
+#     'mismatch'  the response and the challenge do not match
+# validation_counts counts the signatures checked and every reason.
+
+validation_counts = collections.defaultdict(int)
+
+def validate_signature(pk, signature):
+    # returns a reason code, or None if the signature is well formed
+    gf = pk.gf if isinstance(pk, FieldElement) else None
+    def element(a):
+        return isinstance(a, FieldElement) and a.gf == gf and 0 <= a.re < gf.p and 0 <= a.im < gf.p
+    try:
+        blocks, E1 = signature
+        blocks = list(blocks)
+    except (TypeError, ValueError):
+        return 'blocks'
+    if not element(pk) or not element(E1):
+        return 'field'
+    if len(blocks) != nblocks:
+        return 'blocks'
+    if all(isinstance(block, FieldElement) for block in blocks):
+        if not all(map(element, blocks)):
+            return 'field'
+    else:
+        for block in blocks:
+            if not (isinstance(block, tuple) and len(block) == 2):
+                return 'blocks'
+            swap, s = block
+            if swap not in (0, 1):
+                return 'swap'
+            if not (isinstance(s, int) and 0 <= s < 2**f):
+                return 's'
+    for A in (pk, E1):
+        try:
+            Curve(A)
+        except ValueError:
+            return 'singular'
+    return None
+
+def check_signature(pk, signature, message):
+    # validate_signature, then verification; returns the verdict
+    # and the reason code (None for a valid signature)
+    validation_counts['checked'] += 1
+    reason = validate_signature(pk, signature)
+    if reason is None:
+        reason = _verify_validated(pk, signature, message)
+    if reason is not None:
+        validation_counts[reason] += 1
+    return reason is None, reason
+
+def _verify_validated(pk, signature, message):
+    # verification of a well-formed signature; returns the reason code
+    compressed = not isinstance(signature[0][0], FieldElement)
+    verify = verify_compressed_signature if compressed else verify_uncompressed_signature
+    try:
+        if not verify(pk, signature, message):
+            return 'mismatch'
+    except KernelError:
+        return 'kernel'
+    except (ValueError, ArithmeticError):
+        return 'invalid'
+    return None
+
+def test_check_signature():
+    from good_signatures import get_signatures
+    gf = Field(p)
+    pk, sig, compressed = get_signatures(gf.i())[0]
+    blocks, E1 = sig
+    cblocks, _ = compressed
+    validation_counts.clear()
+    gf.counts.clear()
+    for bad, reason in [((blocks[:-1], E1), 'blocks'),
+                        ((blocks, 42), 'field'),
+                        ((blocks[:-1] + [FieldElement._new(gf, p, 0)], E1), 'field'),
+                        ((blocks, gf(2)), 'singular'),
+                        ((cblocks[:-1] + [(2, 0)], E1), 'swap'),
+                        ((cblocks[:-1] + [(0, 2**f)], E1), 's')]:
+        assert check_signature(pk, bad, msg) == (False, reason)
+    assert not gf.counts['mul']         # rejected before any work
+    assert check_signature(pk, ([gf(0)] + blocks[1:], E1), msg) == (False, 'kernel')
+    assert check_signature(pk, sig, b'Goodbye, world!') == (False, 'mismatch')
+    assert check_signature(pk, sig, msg) == (True, None)
+    assert validation_counts['checked'] == 9
+    assert validation_counts['field'] == 2
+
+def _chain_codomains(A24, C24, XK, ZK, n):
+    # the codomains of IsogenyChain(K, n, radix=4) for vectors of curves and
+    # kernels, with the lanes that leave the common path redone one by one;
+    # also returns the reason codes of the lanes that fail, by position
+    A24_, C24_, bad = chain_codomains(A24, C24, XK, ZK, n, radix=4)
+    failed = {}
+    for k in map(int, bad.nonzero()[0]):
+        try:
+            E = Curve._from_A24(A24[k], C24[k])
+            E = IsogenyChain(E(XK[k], ZK[k]), n, radix=4).codomain
+        except KernelError:
+            failed[k] = 'kernel'
+        except (ValueError, ArithmeticError):
+            failed[k] = 'invalid'
+        else:
+            A24_[k], C24_[k] = E.A24, E.C24
+    return A24_, C24_, failed
+
+def _verify_uncompressed_lanes(items):
+    # the reason codes for verify_uncompressed_batch: None, 'mismatch', or
+    # 'kernel'/'invalid' for a signature whose chain fails, which leaves
+    # the lockstep computation right there, so that it costs the others
+    # nothing more
+    reasons = [None] * len(items)
+    groups = {}
+    for j, (pk, signature, message) in enumerate(items):
+        groups.setdefault(len(signature[0]), []).append(j)
+
+    for length, lanes in groups.items():
+        gf = items[lanes[0]][0].gf
+        EA = [Curve(items[j][0]) for j in lanes]
+        A24, C24 = FieldVector(gf, [E.A24 for E in EA]), FieldVector(gf, [E.C24 for E in EA])
+
+        def drop(failed, *vectors):
+            # the vectors without the lanes that failed, and those lanes
+            keep = [k for k in range(len(lanes)) if k not in failed]
+            for k, reason in failed.items():
+                reasons[lanes[k]] = reason
+            return [v[keep] for v in vectors] + [[lanes[k] for k in keep]]
+
+        for b in range(length):
+            XK = FieldVector(gf, [items[j][1][0][b] for j in lanes])
+            A24, C24, failed = _chain_codomains(A24, C24, XK, FieldVector(gf, [1] * len(lanes)), f)
+            A24, C24, lanes = drop(failed, A24, C24)
+            if not lanes:
+                break
+        if not lanes:
+            continue
+
+        E1 = [Curve(items[j][1][1]) for j in lanes]
+        K = [hash_message(E, items[j][2]) for E, j in zip(E1, lanes)]
+        A24c, C24c, failed = _chain_codomains(FieldVector(gf, [E.A24 for E in E1]),
+                                              FieldVector(gf, [E.C24 for E in E1]),
+                                              FieldVector(gf, [P.x for P in K]),
+                                              FieldVector(gf, [P.z for P in K]), 128)
+        A24, C24, A24c, C24c, lanes = drop(failed, A24, C24, A24c, C24c)
+        if not lanes:
+            continue
+
+        for j, verdict in zip(lanes, A24 * C24c == A24c * C24):
+            reasons[j] = None if verdict else 'mismatch'
+    return reasons
+
+def verify_uncompressed_batch(items):
+    # verify_uncompressed_signature for a list of (pk, signature, message):
+    # the chains of all signatures with the same number of blocks run in
+    # lockstep on FieldVectors; a signature whose chain fails is invalid
+    return [reason is None for reason in _verify_uncompressed_lanes(list(items))]
+
+def check_batch(items):
+    # check_signature for a list of (pk, signature, message), with the
+    # well-formed uncompressed signatures verified by verify_uncompressed_batch
+    reasons = [None] * len(items)
+    lanes = []
+    for j, (pk, signature, message) in enumerate(items):
+        validation_counts['checked'] += 1
+        reasons[j] = validate_signature(pk, signature)
+        if reasons[j] is None:
+            if isinstance(signature[0][0], FieldElement):
+                lanes.append(j)
+            else:
+                reasons[j] = _verify_validated(pk, signature, message)
+    for j, reason in zip(lanes, _verify_uncompressed_lanes([items[j] for j in lanes])):
+        reasons[j] = reason
+    for reason in reasons:
+        if reason is not None:
+            validation_counts[reason] += 1
+    return [(reason is None, reason) for reason in reasons]
+
+def test_check_batch():
+    from good_signatures import get_signatures
+    gf = Field(p)
+    (pk, sig, compressed), (pk2, sig2, _) = get_signatures(gf.i())[:2]
+    items = [(pk, sig, msg), (pk, compressed, msg), (pk2, sig2, b'Goodbye, world!'), (pk, (sig[0], gf(2)), msg)]
+    expected = [(True, None), (True, None), (False, 'mismatch'), (False, 'singular')]
+    assert check_batch(items) == expected == [check_signature(*item) for item in items]
+    items.append((pk2, ([gf(0)] + sig2[0][1:], sig2[1]), msg))
+    assert check_batch(items) == expected + [(False, 'kernel')]
+
+# verification on a pool of worker processes: every worker sets up the
+# field once, and signatures travel as plain integers, (re, im) for each
+# field element
+
+def _encode(item):
+    pk, (blocks, E1), message = item
+    x = lambda a: (int(a.re), int(a.im))
+    if blocks and isinstance(blocks[0], FieldElement):
+        blocks = [x(xK) for xK in blocks]
+        compressed = False
+    else:
+        blocks = [(bool(swap), int(s)) for swap,s in blocks]
+        compressed = True
+    return compressed, x(pk), blocks, x(E1), bytes(message)
+
+def _decode(gf, compressed, pk, blocks, E1, message):
+    if not compressed:
+        blocks = [gf(*xK) for xK in blocks]
+    return gf(*pk), (blocks, gf(*E1)), message
+
+_worker_field = None
+
+def _worker_init(p, backend):
+    global _worker_field
+    _worker_field = Field(p, backend)
+
+def _worker_verify(encoded):
+    # returns the verdict and the time it took; a signature
+    # on which verification fails with an error is invalid
+    start = time.perf_counter()
+    compressed, *item = encoded
+    try:
+        item = _decode(_worker_field, compressed, *item)
+        verify = verify_compressed_signature if compressed else verify_uncompressed_signature
+        verdict = verify(*item)
+    except (ValueError, ArithmeticError):
+        verdict = False
+    return verdict, time.perf_counter() - start
+
+def _worker_check_records(records):
+    # check_batch for records in the wire format, see iter_records;
+    # a record that does not decode is invalid, with reason 'decode'
+    items, decoded = [], []
+    for record in records:
+        try:
+            items.append(next(iter_records(_worker_field, record)))
+            decoded.append(True)
+        except (ValueError, StopIteration):
+            decoded.append(False)
+    results = iter(check_batch(items))
+    return [next(results) if ok else (False, 'decode') for ok in decoded]
+
+def verify_batch(items, workers=None, chunksize=1):
+    # verifies (pk, signature, message) triples, compressed or not, on a
+    # pool of worker processes (os.cpu_count() by default), and returns
+    # (verdict, seconds) for each of them, in order
+    items = list(items)
+    if not items:
+        return []
+    gf = items[0][0].gf
+    encoded = [_encode(item) for item in items]
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_worker_init,
+                                                initargs=(int(gf.p), gf.backend)) as pool:
+        return list(pool.map(_worker_verify, encoded, chunksize=chunksize))
+
+def _worker_challenge(E1, message):
+    E2 = recompute_challenge(Curve(_worker_field(*E1)), message)
+    return (int(E2.A24.re), int(E2.A24.im)), (int(E2.C24.re), int(E2.C24.im))
+
+class ConcurrentVerifier:
+    # low-latency verification of single signatures: the challenge is
+    # recomputed on a warm worker process while the response is computed
+    # here, and whichever side fails first ends the verification. The
+    # operations of the worker are not counted in Field.counts.
+    def __init__(self, gf, workers=1):
+        self.gf = gf
+        self._pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_worker_init,
+                                                            initargs=(int(gf.p), gf.backend))
+
+    def verify(self, pk, signature, message):
+        compressed, _, blocks, E1, _ = _encode((pk, signature, message))
+        challenge = self._pool.submit(_worker_challenge, E1, message)
+        try:
+            E = Curve(pk)
+            # only the public-key curve goes into the store
+            kernels = _compressed_kernels(E, signature[0], basis_store) if compressed else None
+            for block in signature[0]:
+                if challenge.done() and challenge.exception():
+                    break
+                E = next(kernels)[1] if compressed else compute_uncompressed_response(E, [block])
+        except BaseException:
+            challenge.cancel()
+            raise
+        A24, C24 = challenge.result()       # raises if the challenge failed
+        return E == Curve._from_A24(self.gf(*A24), self.gf(*C24))
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+import pytest
+
+def test_concurrent_verifier():
+    from good_signatures import get_signatures
+    gf = Field(p)
+    pk, sig, compressed = get_signatures(gf.i())[0]
+    basis_store.clear()
+    with ConcurrentVerifier(gf) as verifier:
+        assert verifier.verify(pk, sig, msg)
+        assert verifier.verify(pk, compressed, msg)
+        assert len(basis_store) == 1
+        assert not verifier.verify(pk, sig, b'Goodbye, world!')
+        with pytest.raises(ValueError):
+            verifier.verify(pk, ([gf(0)] + sig[0][1:], sig[1]), msg)
+
+def test_verify_batch():
+    from good_signatures import get_signatures
+    gf = Field(p)
+    sigs = get_signatures(gf.i())[:2]
+    items = [(pk, sig, msg) for pk,sig,_ in sigs] + [(pk, compressed, msg) for pk,_,compressed in sigs]
+    items += [(sigs[0][0], sigs[0][1], b'Goodbye, world!'), (sigs[0][0], ([gf(0)], sigs[0][1][1]), msg)]
+    results = verify_batch(items, workers=2)
+    assert [verdict for verdict,_ in results] == [True] * 4 + [False] * 2
+    assert all(seconds > 0 for _,seconds in results)
+
+def test_verify_uncompressed_batch():
+    from good_signatures import get_signatures
+    gf = Field(p)
+    sigs = get_signatures(gf.i())[:3]
+    items = [(pk, sig, msg) for pk,sig,_ in sigs] + [(sigs[0][0], sigs[0][1], b'Goodbye, world!')]
+    items.append((sigs[1][0], ([gf(0)] + sigs[1][1][0][1:], sigs[1][1][1]), msg))
+    gf.counts.clear()
+    expected = [verify_uncompressed_signature(*item) for item in items[:-1]]
+    counts = dict(gf.counts)
+    gf.counts.clear()
+    assert verify_uncompressed_batch(items[:-1]) == expected == [True] * 3 + [False]
+    assert dict(gf.counts) == counts       # exactly the same work
+    # the challenge kernel of #6 lies above (0,0), which is redone by itself
+    pk, sig, _ = get_signatures(gf.i())[5]
+    assert verify_uncompressed_batch([(pk, sig, msg)] + items[:2]) == [True] * 3
+    # a kernel (0,0) leaves the common path, and fails as it would by itself,
+    # without holding up the others; it is dropped as soon as it fails
+    gf.counts.clear()
+    assert verify_uncompressed_batch(items) == expected + [False]
+    assert gf.cost() < gf.cost(counts) * 1.05
+    pk, (blocks, E1) = items[-1][:2]
+    items[-1] = pk, (sigs[1][1][0][:-1] + [gf(0)], E1), msg
+    gf.counts.clear()
+    assert _verify_uncompressed_lanes(items) == [None] * 3 + ['mismatch', 'kernel']
+    assert gf.cost() < gf.cost(counts) * 5 / 4          # no challenge for the last one
+
+################################################################
+
+# A streaming pipeline over files of records (see iter_records), behind
+#     python3 sqisign.py verify --input sigs.bin --mode compressed
+# The stages are generators: reading chunks, cutting them into records,
+# decoding, validation, verification. Reading, cutting and decoding run on
+# threads of their own, each with a bounded queue in front of the next
+# stage, so that memory stays flat however large the input is. Validation
+# and verification count field operations, and stay on the consuming
+# thread, so that Field.counts is exact. Besides the reason codes above,
+#     'decode'    a record that is not a valid encoding
+#     'mode'      a signature of the kind the pipeline does not accept
+# A record whose size cannot be told ends the stream with a ValueError,
+# since the records after it cannot be found.
+
+def _staged(stage, *args, maxsize=64):
+    # runs the generator stage(*args) on a thread of its own, and yields
+    # its items through a queue of at most maxsize items; once the consumer
+    # stops, the thread stops as well, and closes the generators among args
+    q = queue.Queue(maxsize)
+    stop = threading.Event()
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def run():
+        items = stage(*args)
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+        finally:
+            items.close()
+            for arg in args:
+                if isinstance(arg, types.GeneratorType):
+                    arg.close()
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            more, item = q.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+def _read_chunks(fp, chunksize):
+    while chunk := fp.read(chunksize):
+        yield chunk
+
+def _cut_records(gf, chunks):
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        offset = 0
+        while (size := _record_size(gf, buf, offset)) is not None and offset + size <= len(buf):
+            yield bytes(buf[offset:offset+size])
+            offset += size
+        del buf[:offset]
+    if buf:
+        raise ValueError('truncated record')
+
+def _decode_records(gf, records):
+    # yields (pk, signature, message) and None, or None and 'decode'
+    for record in records:
+        try:
+            yield next(iter_records(gf, record)), None
+        except ValueError:
+            yield None, 'decode'
+
+def _validate_records(items, mode):
+    for item, reason in items:
+        validation_counts['checked'] += 1
+        if reason is None:
+            pk, signature, _ = item
+            compressed = not isinstance(signature[0][0], FieldElement)
+            if mode not in ('any', ('uncompressed', 'compressed')[compressed]):
+                reason = 'mode'
+            else:
+                reason = validate_signature(pk, signature)
+        yield item, reason
+
+def _verify_records(items):
+    for item, reason in items:
+        if reason is None:
+            reason = _verify_validated(*item)
+        if reason is not None:
+            validation_counts[reason] += 1
+        yield reason
+
+def verify_stream(gf, fp, mode='any', chunksize=1<<16, maxsize=64):
+    # verifies the records of the binary stream fp, and yields a dictionary
+    # for each of them: its index, verdict, reason code and Field.cost
+    chunks = _staged(_read_chunks, fp, chunksize, maxsize=maxsize)
+    records = _staged(_cut_records, gf, chunks, maxsize=maxsize)
+    decoded = _staged(_decode_records, gf, records, maxsize=maxsize)
+    cost = gf.cost()
+    try:
+        for index, reason in enumerate(_verify_records(_validate_records(decoded, mode))):
+            yield {'index': index, 'valid': reason is None, 'reason': reason, 'cost': gf.cost() - cost}
+            cost = gf.cost()
+    finally:
+        decoded.close()
+
+def test_verify_stream():
+    import io
+    from good_signatures import get_signatures
+    gf = Field(p)
+    pk, sig, compressed = get_signatures(gf.i())[0]
+    records = [record_to_bytes(pk, sig, msg), record_to_bytes(pk, compressed, msg),
+               record_to_bytes(pk, sig, b'Goodbye, world!'), record_to_bytes(pk, compressed, msg)]
+    k = 4 + len(msg)
+    records[3] = records[3][:-64-k] + b'\xff' * 64 + records[3][-k:]      # E1 not reduced
+    validation_counts.clear()
+    gf.counts.clear()
+    results = list(verify_stream(gf, io.BytesIO(b''.join(records)), mode='uncompressed', chunksize=100, maxsize=2))
+    assert [(r['valid'], r['reason']) for r in results] == [(True, None), (False, 'mode'), (False, 'mismatch'), (False, 'decode')]
+    assert sum(r['cost'] for r in results) == gf.cost()
+    assert validation_counts['checked'] == 4
+    with pytest.raises(ValueError):
+        list(verify_stream(gf, io.BytesIO(records[0][:-1])))
+
+    # a consumer that stops early stops every stage
+    threads = threading.active_count()
+    stream = verify_stream(gf, io.BytesIO(records[0] * 50), chunksize=100, maxsize=1)
+    next(stream)
+    assert threading.active_count() == threads + 3
+    stream.close()
+    for _ in range(50):
+        if threading.active_count() == threads:
+            break
+        time.sleep(.02)
+    assert threading.active_count() == threads
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='sqisign.py',
+                                     description='without a command, verifies the signatures of good_signatures.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+    verify = commands.add_parser('verify', help='verify a file of records, and write a JSON line for each of them')
+    verify.add_argument('--input', default='-', help='the file of records, - for stdin')
+    verify.add_argument('--mode', choices=('any', 'uncompressed', 'compressed'), default='any',
+                        help='the kind of signatures to accept')
+    verify.add_argument('--chunksize', type=int, default=1<<16, help='bytes read at a time')
+    verify.add_argument('--queue', type=int, default=64, help='bound of the queues between the stages')
+    verify.add_argument('--report', type=float, default=5., help='seconds between reports on stderr')
+    verify.add_argument('--backend', choices=sorted(Field.backends), default='gmpy2')
+    encode = commands.add_parser('encode', help='write the signatures of good_signatures.py as records')
+    encode.add_argument('--output', default='-', help='the file of records, - for stdout')
+    encode.add_argument('--mode', choices=('any', 'uncompressed', 'compressed'), default='any',
+                        help='the kind of signatures to write')
+    encode.add_argument('--repeat', type=int, default=1, help='times to write every signature')
+    args = parser.parse_args(args)
+
+    gf = Field(p, backend=getattr(args, 'backend', None))
+    if args.command == 'encode':
+        from good_signatures import get_signatures
+        out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+        with out:
+            for _ in range(args.repeat):
+                for pk, sig, compressed in get_signatures(gf.i()):
+                    if args.mode != 'compressed':
+                        out.write(record_to_bytes(pk, sig, msg))
+                    if args.mode != 'uncompressed':
+                        out.write(record_to_bytes(pk, compressed, msg))
+        return 0
+
+    fp = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    start = last = time.perf_counter()
+    n = invalid = 0
+    def report():
+        print(f'{n} signatures ({invalid} invalid), {n / (time.perf_counter() - start):.2f}/s, '
+              f'cost {gf.cost() / max(n, 1):.1f} per signature', file=sys.stderr)
+    with fp:
+        try:
+            for result in verify_stream(gf, fp, args.mode, args.chunksize, args.queue):
+                print(json.dumps(result), flush=True)
+                n += 1
+                invalid += not result['valid']
+                if time.perf_counter() - last >= args.report:
+                    last = time.perf_counter()
+                    report()
+        except ValueError as e:
+            print(f'error after {n} records: {e}', file=sys.stderr)
+            return 2
+    report()
+    return 0
+
+################################################################
+
 msg = b'Hello, world!'
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main())
+
     from good_signatures import get_signatures
 
-    gf = Field(p)
+    gf = Field(p, backend='gmpy2')
     sigs = get_signatures(gf.i())
 
     for j,(pk,sig,_) in enumerate(sigs):
@@ -117,7 +949,7 @@ if __name__ == '__main__':
     print()
     print(f'\x1b[35mAVERAGE COST: {gf.cost() / len(sigs)}\x1b[0m')
 
-    gf = Field(p)
+    gf = Field(p, backend='gmpy2')
     sigs = get_signatures(gf.i())
 
     for j,(pk,_,compressed) in enumerate(sigs):
@@ -0,0 +1,158 @@
+
+__all__ = ['CurveStore', 'DecompressionStore']
+
+import collections
+import json
+
+# Precomputations that only depend on the curve, such as its deterministic
+# torsion basis, kept per curve under the affine coefficient A, so that a
+# curve seen before (a returning signer's public key) skips them. The
+# store is an LRU dictionary of bounded size, which can be saved to and
+# loaded from a file, like the strategy tables. Values are field elements.
+
+class CurveStore:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.counts = collections.defaultdict(int)
+        self._entries = collections.OrderedDict()     # (re, im) of A -> {name: (re, im)}
+
+    @staticmethod
+    def _key(E):
+        A = E.A
+        return int(A.re), int(A.im)
+
+    def get(self, E):
+        # the values stored for E, as a dictionary of field elements, or None
+        key = CurveStore._key(E)
+        if key not in self._entries:
+            self.counts['misses'] += 1
+            return None
+        self.counts['hits'] += 1
+        self._entries.move_to_end(key)
+        return {name: E.gf(*a) for name,a in self._entries[key].items()}
+
+    def put(self, E, **values):
+        key = CurveStore._key(E)
+        entry = self._entries.setdefault(key, {})
+        entry.update({name: (int(a.re), int(a.im)) for name,a in values.items()})
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.counts['evictions'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def load(self, path):
+        try:
+            with open(path) as fp:
+                for key, entry in json.load(fp):
+                    self._entries[tuple(key)] = {name: tuple(a) for name,a in entry.items()}
+        except FileNotFoundError:
+            pass
+
+    def save(self, path):
+        with open(path, 'w') as fp:
+            json.dump(list(self._entries.items()), fp)
+
+# The uncompressed forms of compressed signatures seen before, see
+# sqisign.decompress_signature(), keyed by the integers of the public key
+# and the compressed signature, in the same kind of LRU dictionary.
+
+class DecompressionStore:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.counts = collections.defaultdict(int)
+        self._entries = collections.OrderedDict()     # key -> [(re, im) of xK]
+
+    @staticmethod
+    def _key(pk, compressed):
+        blocks, E1 = compressed
+        return (int(pk.re), int(pk.im), int(E1.re), int(E1.im),
+                tuple((bool(swap), int(s)) for swap,s in blocks))
+
+    def get(self, pk, compressed):
+        # the uncompressed signature ([xK], E1), or None
+        key = DecompressionStore._key(pk, compressed)
+        if key not in self._entries:
+            self.counts['misses'] += 1
+            return None
+        self.counts['hits'] += 1
+        self._entries.move_to_end(key)
+        return [pk.gf(*a) for a in self._entries[key]], compressed[1]
+
+    def put(self, pk, compressed, uncompressed):
+        key = DecompressionStore._key(pk, compressed)
+        self._entries[key] = [(int(a.re), int(a.im)) for a in uncompressed[0]]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.counts['evictions'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def load(self, path):
+        try:
+            with open(path) as fp:
+                for key, entry in json.load(fp):
+                    *curves, blocks = key
+                    key = (*curves, tuple((bool(swap), s) for swap,s in blocks))
+                    self._entries[key] = [tuple(a) for a in entry]
+        except FileNotFoundError:
+            pass
+
+    def save(self, path):
+        with open(path, 'w') as fp:
+            json.dump(list(self._entries.items()), fp)
+
+################################################################
+
+import pytest
+
+from field import Field
+from curve import Curve
+
+class Test:
+    @staticmethod
+    def test_store(tmp_path):
+        gf = Field(2**127 - 1)
+        E, F = Curve(gf(6)), Curve(gf(7))
+        store = CurveStore(maxsize=1)
+        assert store.get(E) is None
+        store.put(E, P=gf(1, 2))
+        store.put(E, Q=gf(3))
+        assert store.get(E) == {'P': gf(1, 2), 'Q': gf(3)}
+        assert store.get(Curve(gf(12), gf(2))) == store.get(E)     # the same curve
+        store.put(F, P=gf(4))
+        assert store.get(E) is None
+        assert dict(store.counts) == {'hits': 3, 'misses': 2, 'evictions': 1}
+
+        path = tmp_path / 'store.json'
+        store.save(path)
+        store = CurveStore()
+        store.load(path)
+        assert store.get(F) == {'P': gf(4)}
+
+    @staticmethod
+    def test_decompression_store(tmp_path):
+        gf = Field(2**127 - 1)
+        pk, E1 = gf(6), gf(1, 2)
+        compressed = [(True, 5), (False, 7)], E1
+        store = DecompressionStore()
+        assert store.get(pk, compressed) is None
+        store.put(pk, compressed, ([gf(3, 4), gf(5)], E1))
+        assert store.get(pk, compressed) == ([gf(3, 4), gf(5)], E1)
+        assert store.get(pk, ([(True, 5), (True, 7)], E1)) is None
+
+        path = tmp_path / 'store.json'
+        store.save(path)
+        store = DecompressionStore()
+        store.load(path)
+        assert store.get(pk, compressed) == ([gf(3, 4), gf(5)], E1)
@@ -0,0 +1,197 @@
+
+__all__ = ['naive_strategy', 'balanced_strategy', 'optimal_strategy', 'step_costs', 'load_table', 'save_table']
+
+import json
+import functools
+
+# A strategy for a chain of n 2-isogenies is a list of integers.
+# Walking the chain keeps a stack of points together with their height
+# (the number of doublings until they have order 2). Whenever the top
+# point has height h > 1 we take the next integer m from the strategy,
+# double that point m times and push the result with height h-m.
+# Whenever the top point has height 1 it is a kernel, and everything
+# else on the stack is pushed through the 2-isogeny. This is the same
+# encoding as the SIKE strategies, read in pre-order.
+#
+# With radix 4, points of height 2 are kernels of 4-isogenies as well,
+# so those are leaves too. The strategies below only ever split off an
+# even height, so there is at most one 2-isogeny, at the very end, but
+# any other (mixed) strategy works with IsogenyChain just as well.
+
+def _unroll(n, split, radix=2):
+    # turn a split function h -> m into a flat list of integers
+    strategy = []
+    todo = [n]
+    while todo:
+        h = todo.pop()
+        if h <= radix // 2:
+            continue
+        m = split(h)
+        assert 1 <= m < h
+        strategy.append(m)
+        todo += [m, h - m]     # the pushed point is handled first
+    return strategy
+
+def naive_strategy(n, radix=2):
+    if radix == 4:
+        return _unroll(n, lambda h: 1 if h == 3 else h - 2, radix)
+    return _unroll(n, lambda h: h - 1)
+
+def balanced_strategy(n, radix=2):
+    if radix == 4:
+        return _unroll(n, lambda h: h - 2*max(1, h // 4), radix)
+    return _unroll(n, lambda h: h // 2)
+
+################################################################
+
+@functools.cache
+def _measured_counts():
+    # count the field operations of a doubling, of computing 2- and
+    # 4-isogenies and of pushing a point through them, so the costs
+    # follow the formulas we actually use
+    from field import Field
+    from curve import Curve
+    from isogeny import TwoIsogeny, FourIsogeny
+
+    gf = Field(2**31 - 1)
+    E = Curve(gf(0))
+    K = 2**29 * E(gf(1, 2))                 # of order 4, above (i,0)
+    K2, K4 = E.xDBL(K), K
+    P = E(123, 1)
+
+    counts = {}
+    def measure(name, f, *args):
+        gf.counts.clear()
+        ret = f(*args)
+        counts[name] = dict(gf.counts)
+        return ret
+    measure('dbl', E.xDBL, P)
+    phi = measure('isog2', TwoIsogeny, K2)
+    measure('eval2', phi, P)
+    psi = measure('isog4', FourIsogeny, K4)
+    measure('eval4', psi, P)
+    return counts
+
+def step_costs(weights=None):
+    # returns the costs of the operations in a chain ('dbl', 'isog2',
+    # 'eval2', 'isog4', 'eval4'), weighted by Field.weights or by any
+    # other (measured) weights
+    from field import Field
+    if weights is None:
+        weights = Field.weights
+    cost = lambda counts: sum(weights[k]*c for k,c in counts.items())
+    return {name: cost(counts) for name,counts in _measured_counts().items()}
+
+################################################################
+
+_table = {}
+
+def _key(n, radix, costs):
+    return f'{n}:{radix}:' + ':'.join(f'{k}={costs[k]!r}' for k in sorted(costs))
+
+def optimal_strategy(n, radix=2, costs=None):
+    # costs are as returned by step_costs()
+    if costs is None:
+        costs = step_costs()
+    key = _key(n, radix, costs)
+    if key not in _table:
+        _table[key] = _optimal(n, radix, costs)
+    return list(_table[key])
+
+def _optimal(n, radix, costs):
+    # dynamic programming (cf. De Feo-Jao-Plût, SIKE):
+    # a point of height h is doubled m times, the subtree of height h-m
+    # is computed, pushing the point through it, then the subtree of height m
+    #     C[h] = min_m  C[h-m] + C[m] + m*dbl + V[h-m]
+    # where V[h] is the cost of pushing one point through h levels;
+    # with radix 4 only even heights h-m are split off, so that
+    # V[h] does not depend on the shape of the subtree
+    p = costs['dbl']
+    if radix == 4:
+        V = lambda h: h // 2 * costs['eval4'] + h % 2 * costs['eval2']
+        C = [0., costs['isog2'], costs['isog4']]
+    else:
+        V = lambda h: h * costs['eval2']
+        C = [0., costs['isog2']]
+    S = [None] * len(C)
+    for h in range(len(C), n + 1):
+        C.append(None)
+        S.append(None)
+        for l in range(radix // 2, h, radix // 2):
+            m = h - l
+            c = C[l] + C[m] + m*p + V(l)
+            if C[h] is None or c < C[h]:
+                C[h], S[h] = c, m
+    return _unroll(n, lambda h: S[h], radix)
+
+def load_table(path):
+    try:
+        with open(path) as fp:
+            _table.update(json.load(fp))
+    except FileNotFoundError:
+        pass
+
+def save_table(path):
+    with open(path, 'w') as fp:
+        json.dump(_table, fp)
+
+################################################################
+
+import pytest
+import random
+
+class Test:
+    @staticmethod
+    def test_shapes():
+        for n in range(1, 40):
+            for strategy in (naive_strategy(n), balanced_strategy(n), optimal_strategy(n)):
+                assert len(strategy) == n - 1
+            for strategy in (naive_strategy(n, 4), balanced_strategy(n, 4), optimal_strategy(n, 4)):
+                assert len(strategy) == (n + 1) // 2 - 1
+
+    @staticmethod
+    def test_optimal_is_cheapest():
+        from isogeny import IsogenyChain
+        from field import Field
+        from curve import Curve
+        gf = Field(2**31 - 1)
+        E = Curve(gf(0))
+        K = E(23, 1)
+        for radix in (2, 4):
+            costs = {}
+            for name in ('naive', 'balanced', 'optimal'):
+                gf.counts.clear()
+                IsogenyChain(K, 29, strategy=name, radix=radix)
+                costs[name] = gf.cost()
+            assert costs['optimal'] <= costs['balanced'] <= costs['naive']
+
+    @staticmethod
+    def test_table(tmp_path):
+        path = tmp_path / 'strategies.json'
+        costs = {k: random.random() + c for k,c in step_costs().items()}
+        strategy = optimal_strategy(77, 4, costs)
+        save_table(path)
+        _table.clear()
+        load_table(path)
+        assert _table[_key(77, 4, costs)] == strategy
+
+################################################################
+
+if __name__ == '__main__':
+    # compare the strategies on the chains that SQIsign verification computes
+    from field import Field
+    from curve import Curve
+    from isogeny import IsogenyChain
+    from sqisign import p, f, deterministic_basis_two_torsion
+
+    gf = Field(p)
+    E = Curve(gf(6))
+    K, _ = deterministic_basis_two_torsion(E)
+
+    print(f'step costs: {step_costs()}')
+    for radix in (2, 4):
+        for name in ('naive', 'balanced', 'optimal'):
+            gf.counts.clear()
+            phi = IsogenyChain(K, f, strategy=name, radix=radix)
+            counts = ', '.join(f'{k}: {c}' for k,c in sorted(gf.counts.items()))
+            print(f'{name:>10} (radix {radix}):  cost {gf.cost():9.1f}   ({counts})')